@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
 import argparse
+import signal
+import time
+import zlib
 
-import cv2
 import numpy as np
 
 from functions import *
 from functools import partial
+from camera import CameraCapture
+from detection_pipeline import DetectionPipeline
+from tracking import create_tracker, track_marker, find_pen_blobs, highlight_pens
+from stroke_log import StrokeLog
+from instrumentation import metrics
+from color_classifier import load_pens, pens_from_dict, pens_to_dict, compile_pens, pen_mask, classify
+from scheduler import FrameScheduler
+from cursor_filter import FILTERS
+from tiled_canvas import parse_canvas_size
+from paint_by_number import PALETTES
+from live_view import LiveViewServer, parse_address
+from display import DisplayManager
+from background_saver import BackgroundSaver, load_autosave
+from frame_sources import open_frame_source, is_live_source, SessionRecorder, SessionReplay
 
 def main():
     # -----------------------------------------------
@@ -14,23 +30,99 @@ def main():
     
     #....Programm arguments creation....
     parser = argparse.ArgumentParser(description='PSR AR Paint Aplication')
-    parser.add_argument('-j', '--JSON', type=str, help='Full path to the JSON file', required=True)
-    parser.add_argument('-usp', '--use_shake_prevention', type=int, help='Set the value for the shakedown - recomended: 50', required=False)
+    parser.add_argument('-j', '--JSON', type=str, help='Full path to the JSON file (not needed when replaying)')
+    parser.add_argument('-usp', '--use_shake_prevention', type=int, help='Biggest jump (pixels) drawn as a line, a bigger one starts a new line - recomended: 50', required=False)
+    parser.add_argument('-cf', '--cursor_filter', type=str, choices=list(FILTERS), default='none', help='Filter for the pen position: none, one_euro or kalman. Default: none')
+    parser.add_argument('-pms', '--predict_ms', type=float, default=0, help='Draw the pen this many milliseconds ahead of the camera, to hide the latency. Default: 0')
+    parser.add_argument('-gap', '--max_gap_ms', type=float, default=150, help='A pen lost for less than this (ms) is joined with a curve. Default: 150')
     parser.add_argument('-ucs','--use_camera_stream', action='store_true', help='Use the camera stream as a canvas instead of a white board')
     parser.add_argument('-pbn','--paint_by_number', action='store_true', help='Use to paint in paint-by-number mode. Use_camara_stream overrides this argument')
     parser.add_argument('-d', '--dificulty', type=int, help='How exigent will be the program while evaluating your drawing capabilities\nOnly takes effect when using paint-by-number mode\nDefault Value = 1 - easy',
                         choices=[1,2,3],default=1)
+    parser.add_argument('-pg', '--puzzle_grid', type=int, default=3, help='Wavy lines in each direction of the paint-by-number puzzle, (N+1)^2 cells. Default: 3')
+    parser.add_argument('-pr', '--puzzle_regions', type=int, help='Join the puzzle cells into this many regions. Default: every cell is a region')
+    parser.add_argument('-pp', '--puzzle_palette', type=str, choices=list(PALETTES), default='rgb', help='Colors of the puzzle numbers, keys 1-9 choose them. Default: rgb')
+    parser.add_argument('-ps', '--puzzle_seed', type=int, help='Seed of the paint-by-number puzzle, the same seed gives the same puzzle. Default: a new one every time')
+    parser.add_argument('-pc', '--puzzle_cache', type=str, default='./puzzle_cache', help='Directory where the puzzles of a fixed seed (-ps, replays, resumed drawings) are kept, "none" to always generate them. Default: ./puzzle_cache')
+    parser.add_argument('-cs', '--canvas_size', type=str, help='Draw in a tiled canvas of this size (e.g. 8k, 4k or 5000x3000) instead of the camera size, white board only. [ ] zoom, H J K L pan')
+    parser.add_argument('-mp', '--multi_pen', action='store_true', help='Every pen of the JSON file draws at the same time with its own color and thickness')
+    parser.add_argument('-src', '--source', type=str, default='0', help='Camera number, video file, image directory or .raw frame dump. Default: camera 0')
+    parser.add_argument('-rec', '--record', type=str, help='Directory where the session (frames, keys and mouse) is recorded')
+    parser.add_argument('-rep', '--replay', type=str, help='Directory of a recorded session to run again, as fast as possible')
+    parser.add_argument('--headless', action='store_true', help='Do not open any window')
+    parser.add_argument('-tw', '--tile_windows', action='store_true', help='Show all the views in one window')
+    parser.add_argument('-pl', '--pipeline', action='store_true', help='Capture and detect the pens in another process, the frames are shared through shared memory')
+    parser.add_argument('-tfps', '--target_fps', type=str, default='30', help='Frames per second to aim for, or "latency" to process every frame as soon as it arrives. Default: 30')
+    parser.add_argument('-fps', '--show_fps', action='store_true', help='Show the FPS and the time of every stage in the camera window')
+    parser.add_argument('-as', '--autosave', type=str, help='Directory where the drawing is saved every few seconds, in the background')
+    parser.add_argument('-asi', '--autosave_interval', type=float, default=10, help='Seconds between autosaves. Default: 10')
+    parser.add_argument('--resume', action='store_true', help='Continue the drawing saved in the autosave directory')
+    parser.add_argument('-lv', '--live_view', type=str, help='Stream the canvas to other screens (MJPEG over HTTP) on PORT (this computer only) or HOST:PORT, e.g. 0.0.0.0:8080 for the LAN')
+    parser.add_argument('-lvq', '--live_view_quality', type=int, default=80, help='JPEG quality of the live view. Default: 80')
+    parser.add_argument('-met', '--metrics', type=str, help='JSON-lines file where the stage histograms and the slow frames are saved')
 
     args = vars(parser.parse_args())
+    if args['canvas_size'] is not None and (args['use_camera_stream'] or args['paint_by_number']):
+        parser.error('--canvas_size only works with the white board')
+    if args['resume'] and args['autosave'] is None:
+        parser.error('--resume needs the -as/--autosave directory')
 
-    #.... Setting the color limits....
-    color_limits = load_color_limits(args['JSON'])
+    #....Recorded session....
+    replay = None
+    if args['replay'] is not None:
+        replay = SessionReplay(args['replay'])
+        args.update(replay.settings['args']) #Same options as the recorded session
+        pens = pens_from_dict(replay.settings['pens'])
+        seed = replay.settings['seed']
+    elif args['JSON'] is None:
+        parser.error('the following arguments are required: -j/--JSON')
+    else:
+        #.... Setting the color limits....
+        pens = load_pens(args['JSON'])
+        seed = args['puzzle_seed'] if args['puzzle_seed'] is not None else int(time.time())
+
+    #....Autosaved drawing....
+    autosaved = None
+    if args['resume'] and replay is None:
+        autosaved = load_autosave(args['autosave'])
+        if autosaved is None:
+            print('Nothing to resume, starting a new drawing')
+        else:
+            args.update(autosaved['meta']['args']) #The canvas has to be the same one
+            seed = autosaved['meta']['seed']
+    headless = args['headless']
+
+    #....Instrumentation, disabled unless asked for....
+    if args['show_fps'] or args['metrics'] is not None:
+        metrics.configure(enabled=True, export_path=args['metrics'])
+
+    recorder = None
+    if args['record'] is not None:
+        recorded_args = {k: args[k] for k in ('use_shake_prevention', 'use_camera_stream', 'paint_by_number', 'dificulty', 'multi_pen', 'canvas_size',
+                                             'puzzle_grid', 'puzzle_regions', 'puzzle_palette',
+                                             'cursor_filter', 'predict_ms', 'max_gap_ms')}
+        recorder = SessionRecorder(args['record'], {'args': recorded_args, 'pens': pens_to_dict(pens), 'seed': seed})
 
     #....Camera Initialization....
-    vid = cv2.VideoCapture(0)
-    ret, frame = vid.read()
+    if args['pipeline']:
+        #The worker process opens the source itself, only live cameras drop frames when the UI is behind
+        source = replay.frames_path if replay is not None else args['source']
+        camera = DetectionPipeline(source, pens if args['multi_pen'] else pens[:1], args['multi_pen'],
+                                   drop_frames=replay is None and is_live_source(args['source']))
+    elif replay is not None:
+        camera = CameraCapture(replay.source, threaded=False) #Every recorded frame is used
+    else:
+        #Only the live camera is captured on a separate thread, files are read frame by frame
+        camera = CameraCapture(open_frame_source(args['source']), threaded=is_live_source(args['source']))
+    ret, frame = camera.start()
+    if not ret:
+        print('Could not read from the camera')
+        return
     h, w, nc = frame.shape
 
+    #....Windows, created once and only updated when their image changes....
+    display = DisplayManager((w, h), headless=headless, tiled=args['tile_windows'])
+
     #....Canvas Creation....
     areas = None
 
@@ -38,151 +130,230 @@ def main():
         canvas = np.ones((h, w, 3), dtype=np.uint8) #"Transparent" board
     else: 
         canvas = np.ones((h, w, 3), dtype=np.uint8) * 255 #White board
-    default_img = canvas.copy()
 
     #....Image data storing...
-    drawing_data = {'img': canvas, 'pencil_down': False, 'previous_x': 0, 'previous_y': 0, 'color': (255, 255, 255), 'thickness': 5, 'drawing': False, 'drawing_mode': None, 'start_pos': (0, 0), 'temp_img': canvas.copy(),'score_board':None}
+    drawing_data = create_drawing_data(canvas)
 
     if not args['use_camera_stream'] and args['paint_by_number']:
-        areas = segment_image(drawing_data,h, w)
+        #The seed is saved with recorded sessions and autosaves, so the same puzzle comes back
+        #A seed taken from the clock never comes back, that puzzle is not cached
+        seed_repeats = replay is not None or autosaved is not None or args['puzzle_seed'] is not None
+        cache_dir = args['puzzle_cache'] if args['puzzle_cache'].lower() != 'none' and seed_repeats else None
+        areas = segment_image(drawing_data, h, w, seed, cache_dir, grid=args['puzzle_grid'],
+                              regions=args['puzzle_regions'], palette=args['puzzle_palette'])
         dificulty = args['dificulty']
         drawing_data['score_board'] =  np.ones((100, 300, 3), dtype=np.uint8)
-        cv2.imshow('Score', drawing_data['score_board'])
+        display.show('Score', drawing_data['score_board'], areas['score'])
 
-    cv2.namedWindow("canvas")
-    cv2.moveWindow("canvas", 800,300)
-    cv2.setMouseCallback("canvas", partial(mouseCallback, drawing_data=drawing_data))
+    if args['canvas_size'] is not None:
+        create_tiled_canvas(drawing_data, *parse_canvas_size(args['canvas_size'])) #The camera only sees a viewport of it
 
-    #....Shakedown initialization....
-    prev_center = None
-    if args['use_shake_prevention'] == None:
-        use_shake  = False
-    else:
-        use_shake = True
-        shake_threshold = args['use_shake_prevention']   
+    #Clearing goes back to the initial canvas (the puzzle in paint-by-number mode)
+    default_img = drawing_image(drawing_data).copy()
+    drawing_data['log'] = StrokeLog(default_img) #Everything drawn is recorded for undo/redo
+    if args['use_camera_stream']:
+        create_ink_layer(drawing_data) #Only the pixels with ink are put over the camera image
+
+    if autosaved is not None:
+        restored = autosaved['image']
+        if restored.shape != drawing_image(drawing_data).shape:
+            print(f'The autosave is {restored.shape[1]}x{restored.shape[0]}, it can not be resumed with this camera')
+        else:
+            replace_drawing_image(drawing_data, restored)
+            if autosaved['commands'] is not None: drawing_data['log'].restore(autosaved['commands'], restored)
+            if drawing_data['view'] is not None:
+                drawing_data['view'].update(autosaved['meta']['view'])
+                pan_viewport(drawing_data['view'], restored, 0, 0) #Keeps it inside the canvas
+            print(f"Resumed the drawing from {args['autosave']}")
+
+    #....Saving, done by another thread....
+    saver = BackgroundSaver(args['autosave'], args['autosave_interval'])
+    drawing_data['saver'] = saver
+    autosave_settings = {'args': {k: args[k] for k in ('use_camera_stream', 'paint_by_number', 'dificulty', 'puzzle_grid',
+                                                                 'puzzle_regions', 'puzzle_palette', 'canvas_size')}, 'seed': seed}
+
+    mouse_callback = partial(mouseCallback, drawing_data=drawing_data)
+    display.set_mouse_callback('canvas', recorder.mouse_callback(mouse_callback) if recorder is not None else mouse_callback)
+
+    #....Live view for other screens, encoded and sent by its own threads....
+    live_view = None
+    if args['live_view'] is not None:
+        live_view = LiveViewServer(*parse_address(args['live_view']), quality=args['live_view_quality'])
+        if not live_view.start(): live_view = None
+
+    #....Frame pacing, replaces a fixed wait....
+    scheduler = FrameScheduler(args['target_fps'], headless=headless)
+
+    #....Pen tracking initialization....
+    #The color limits are turned into lookup tables only once, the first pen of the file is used
+    classifier = compile_pens(pens[:1])
+    segment = partial(pen_mask, classifier=classifier, index=0)
+    tracker = create_tracker()
+
+    #....Cursor filter initialization, between the centroids and the drawing....
+    cursor_settings = {'cursor_filter': args['cursor_filter'], 'predict_ms': args['predict_ms'],
+                       'max_gap_ms': args['max_gap_ms'], 'max_jump': args['use_shake_prevention']}
+    pen_cursor = create_cursor(**cursor_settings)
+    if args['multi_pen']:
+        #All the pens are found in one label image
+        multi_classifier = compile_pens(pens)
+        pen_cursors = create_pen_cursors(pens, **cursor_settings)
 
     # -----------------------------------------------
     # Execution
     # -----------------------------------------------
 
+    #....Stopping a headless session, there is no window to press q in....
+    #Ctrl-C or a kill ends the frame loop like q, so the drawing is still autosaved and everything is closed
+    stop = {'requested': False}
+    if headless:
+        def request_stop(signum, stack):
+            print('Stopping')
+            stop['requested'] = True
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+
     # -----------------------------------------------
     # Visualization
     # -----------------------------------------------
-    while True:
-        #....Camera capturing continuously....
-        ret, frame = vid.read()
-        cv2.namedWindow('Camera Feedback')
-        cv2.moveWindow('Camera Feedback', 40, 10)
-        cv2.imshow('Camera Feedback',frame)
-
-        #...Image processing....
-        lower_bound = np.array([color_limits['B']['min'], color_limits['G']['min'], color_limits['R']['min']], dtype=np.uint8)
-        upper_bound = np.array([color_limits['B']['max'], color_limits['G']['max'], color_limits['R']['max']], dtype=np.uint8)
-
-        mask = cv2.inRange(frame, lower_bound, upper_bound)
-
-        cv2.namedWindow('Biggest Area Highlight')
-        cv2.moveWindow('Biggest Area Highlight', 40,850)
-        #....Biggest area Selection....
-        connectivity = 4  
-        output = cv2.connectedComponentsWithStats(mask, connectivity, cv2.CV_32S)
-        num_labels = output[0]  #Number of different group of pixels
-        labels = output[1]      #Matrices with the different group of pixels
-        stats = output[2]       #Saves some important stats (in this example, the important one its the area)
-        centroids = output[3]   #Calculates the different centroids of the groups
-
-        if num_labels > 1:
-            largest_object_idx = 1 + stats[1:, cv2.CC_STAT_AREA].argmax()   #Stores the index of the biggest area
-
-            largest_object_mask = (labels == largest_object_idx).astype(np.uint8)*255   #Creates a mask
-            largest_object_mask = cv2.cvtColor(largest_object_mask, cv2.COLOR_GRAY2BGR) #Convert to color to merge
-
-            frame_with_highlight = cv2.addWeighted(frame, 1, largest_object_mask, 0.5, 0)   #Merging the camera image with the mask
-			
-            #....Centroid calcultion and drawing....
-            if len(centroids) > 0:
-                current_center = centroids[largest_object_idx] #Saves the centroid coordinates
-                center_x = int(current_center[0])
-                center_y = int(current_center[1])
-                current_center = (center_x, center_y) #this is needed because centroids came in float type
-                cv2.line(frame_with_highlight, (center_x-5,center_y-5), (center_x+5,center_y+5), (0, 0, 255), 2) #Draws a cross in the centroid position
-                cv2.line(frame_with_highlight, (center_x+5,center_y-5), (center_x-5,center_y+5), (0, 0, 255), 2)
-                
-                if use_shake == False:
+    frame_index = -1
+    try:
+        while not stop['requested']:
+            scheduler.start_frame()
+            #....Camera capturing continuously....
+            ret, frame, frame_time = camera.read() #Always the newest frame, older ones are dropped
+            if not ret:
+                if camera.running:
+                    continue
+                print('Camera stopped')
+                break
+            metrics.lap('capture')
+            scheduler.frame_captured(frame_time, camera.captured) #The budget of the latency mode
+            if args['pipeline']: metrics.add('worker_detection', camera.detection_time) #Done in parallel, not part of the frame time
+            frame_index += 1
+            if recorder is not None: recorder.frame(frame, frame_time)
+            #The cursor filters use the capture time, a replay uses the recorded one
+            timestamp = replay.frame_time(frame_index) if replay is not None else frame_time
+            display.show('Camera Feedback', frame, prepare=(lambda img: metrics.overlay(img.copy())) if args['show_fps'] else None)
+            metrics.lap('gui')
+
+            #....Biggest area Selection....
+            if args['multi_pen']:
+                #One label image and one connected components pass for all the pens
+                pen_blobs = camera.blobs if args['pipeline'] else find_pen_blobs(classify(frame, multi_classifier), len(pens))
+                metrics.lap('detection')
+                for cursor, pen_blob in zip(pen_cursors, pen_blobs):
+                    update_pen_cursor(drawing_data, cursor, pen_blob, timestamp)
+                metrics.lap('drawing')
+                #The highlight is only made when it is shown
+                display.show('Biggest Area Highlight', frame, prepare=partial(highlight_pens, blobs=pen_blobs, colors=[c['color'] for c in pen_cursors]))
+                blob = None
+            else:
+                #Only a window around the last position is searched while the pen is being tracked
+                blob = camera.blobs[0] if args['pipeline'] else track_marker(frame, segment, tracker)
+                metrics.lap('detection')
+                #The path of the pen since the last frame, it starts at the previous position when the line goes on
+                path = move_pen_cursor(pen_cursor, blob, timestamp)
+                end_pen_stroke(drawing_data, pen_cursor, path) #Lost, jumped or back after a gap: the next line is a new stroke
+
+            if blob is not None:
+                if len(path) == 1:
+                    drawing_data['previous_x'], drawing_data['previous_y'] = path[0] #A new line starts here
+                for x, y in (path if len(path) == 1 else path[1:]):
                     #Line Drawing
                     if drawing_data['drawing_mode'] == 'Line':
-                        cv2.line(drawing_data['img'], (drawing_data['previous_x'], drawing_data['previous_y']), (center_x, center_y), drawing_data['color'], drawing_data['thickness'])
+                        draw_line(drawing_data, (drawing_data['previous_x'], drawing_data['previous_y']), (x, y))
                     #Keeps changing the starting postition until the figure drawing starts
                     if drawing_data['drawing'] == False:
-                        drawing_data['start_pos'] = (center_x, center_y)
+                        drawing_data['start_pos'] = (x, y)
                     #If the drawing mode has changed, it will draw the respective figure
                     draw_shape(drawing_data)
-                #Updates the position
-                drawing_data['previous_x'] = center_x
-                drawing_data['previous_y'] = center_y
+                    #Updates the position
+                    drawing_data['previous_x'] = x
+                    drawing_data['previous_y'] = y
 
-            else:
-                current_center = None #Just in case it doesn't find any centroid
-                
-            if use_shake:
-                if prev_center is not None and current_center is not None: #To calculate a diference is needed to have two different positions
-                    dx, dy = abs(current_center[0] - prev_center[0]), abs(current_center[1] - prev_center[1])   #Difference calculation
-                    max_difference = max(np.abs(dx), np.abs(dy))
-                    
-                    #Only draws if there hasn't been a jump
-                    if max_difference <= shake_threshold:
-                        if drawing_data['drawing_mode'] == 'Line':
-                            cv2.line(drawing_data['img'], prev_center, current_center, drawing_data['color'], drawing_data['thickness'])
-                        if drawing_data['drawing'] == False:
-                            drawing_data['start_pos'] = (center_x, center_y)
-                
-                        draw_shape(drawing_data)
-                
-                prev_center = current_center #updates the postion
-            
-            #....Showing the highlight and centroid result....
-            cv2.imshow('Biggest Area Highlight', frame_with_highlight)
-        else:
-            cv2.imshow('Biggest Area Highlight', frame)
+                metrics.lap('drawing')
+                #....Showing the highlight (camera image merged with the mask) and a cross in the centroid....
+                display.show('Biggest Area Highlight', frame, prepare=partial(highlight_pens, blobs=[blob], colors=[(0, 0, 255)]))
+            elif not args['multi_pen']:
+                display.show('Biggest Area Highlight', frame)
+            metrics.lap('gui')
         
         
-        #....Canvas updating....
-        if args['use_camera_stream']:
-            #We need to merge the transparent board with the camera image
-            if drawing_data['drawing']:
-                #The temp image represents the drawing of a shape that is not yet finished
-                camera_and_canvas = cv2.addWeighted(frame, 1, drawing_data['temp_img'], 1, 0)
-                cv2.imshow('canvas', camera_and_canvas)
-            else:
-                #Here the image update its final
-                camera_and_canvas = cv2.addWeighted(frame, 1, drawing_data['img'], 1, 0)
-                cv2.imshow('canvas', camera_and_canvas)
-        else:
-            if drawing_data['drawing']:
-                cv2.imshow('canvas', drawing_data['temp_img'])
-            else:
-                cv2.imshow('canvas', drawing_data['img'])
+            #....Canvas updating....
+            camera_and_canvas = compose_canvas(frame, drawing_data, args['use_camera_stream'])
+            if drawing_data['canvas'] is not None: drawing_data['canvas'].compress_cold() #A few tiles per frame
+            metrics.lap('composite')
+            #The white board only changes when something is drawn, the camera stream every frame
+            display.show('canvas', camera_and_canvas, None if args['use_camera_stream'] else drawing_data['version'])
+            if live_view is not None: live_view.publish(camera_and_canvas) #Only a copy, the encoding is done by the live view thread
+            metrics.lap('gui')
         
-        #....Periodically updates score....
-        if not args['use_camera_stream'] and args['paint_by_number']:
-            calculate_score(drawing_data, dificulty, areas)
-            cv2.namedWindow('Score')
-            cv2.moveWindow('Score',800,10)
-            cv2.imshow('Score', drawing_data['score_board'])
-
-        #....Key awaiting....
-        key = cv2.waitKey(50)
-
-        # Changes program behavior according to key pressed
-        if key == ord('q'):
-            print('Quitting program')
-            break
-        else: pressed_key(key, drawing_data, default_img, areas)
+            #....Periodically updates score....
+            #When the machine can't keep up the score is updated less often, the pen is never skipped
+            if not args['use_camera_stream'] and args['paint_by_number'] and (replay is not None or scheduler.should_score()):
+                calculate_score(drawing_data, dificulty, areas)
+                metrics.lap('score')
+                display.show('Score', drawing_data['score_board'], areas['score']) #Only when the score changed
+                metrics.lap('gui')
+            display.flush() #The tiled window gets all its views at once
+            camera.frame_displayed(frame_time)
+            metrics.lap('gui')
 
-    # -----------------------------------------------
-    # Termination
-    # -----------------------------------------------
-    cv2.destroyWindow('image_rgb')
+            #....Key awaiting....
+            if replay is not None:
+                #The recorded events are used instead of the real ones, without waiting
+                display.wait_key(1)
+                for event in replay.mouse_events(frame_index):
+                    mouse_callback(*event)
+                key = replay.key(frame_index)
+            else:
+                key = scheduler.wait_key() #Waits only what is left of the frame time
+                if recorder is not None: recorder.key(key)
+            metrics.lap('wait')
+
+            # Changes program behavior according to key pressed
+            if key == ord('q'):
+                print('Quitting program')
+                break
+            else: pressed_key(key, drawing_data, default_img, areas)
+            metrics.lap('keys')
+
+            #....Periodic autosave, the frame loop only takes the snapshot....
+            if saver.autosave_due():
+                autosave(saver, drawing_data, autosave_settings)
+                metrics.lap('save')
+            metrics.frame_done()
+
+    finally:
+        # -----------------------------------------------
+        # Termination
+        # -----------------------------------------------
+        camera.release()
+        if args['autosave'] is not None: autosave(saver, drawing_data, autosave_settings, block=True) #Waits for room, never skipped
+        saver.close() #Waits for the saves that are not written yet
+        if live_view is not None: live_view.close()
+        metrics.close()
+        if recorder is not None: recorder.release()
+        if recorder is not None or replay is not None:
+            #Same checksum means the replay drew exactly the same canvas
+            print(f"Canvas checksum: {zlib.crc32(drawing_array(drawing_data).tobytes()):08x}")
+        stats = camera.stats()
+        print(f"Frames captured: {stats['captured']}, shown: {stats['delivered']}, dropped: {stats['dropped']}")
+        print(f"Capture to display latency: {stats['latency_ms_mean']:.1f} ms mean, {stats['latency_ms_p95']:.1f} ms p95")
+        if drawing_data['canvas'] is not None:
+            stats = drawing_data['canvas'].stats()
+            print(f"Canvas tiles: {stats['hot']} uncompressed, {stats['cold']} compressed, {stats['bytes'] / 1e6:.1f} MB of {stats['full_bytes'] / 1e6:.1f} MB")
+        stats = saver.stats()
+        if args['autosave'] is not None or stats['saved'] > 0:
+            print(f"Background saves: {stats['saved']} drawings, {stats['autosaves']} autosaves ({stats['tiles_written']} tiles written), {stats['skipped']} skipped")
+        if live_view is not None:
+            stats = live_view.stats()
+            print(f"Live view: {stats['encoded']} frames encoded ({stats['encode_ms_mean']:.1f} ms each), {stats['sent']} sent, {stats['skipped']} skipped by slow viewers")
+        stats = scheduler.stats()
+        if replay is None:
+            print(f"Frame deadline misses: {stats['deadline_misses']} of {stats['frames']} ({stats['mode']} mode), skipped scores: {stats['skipped_scores']}")
+        display.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,167 @@
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+from stroke_log import save_log
+from tiled_canvas import TiledCanvas, TILE_SIZE
+
+# Saves the drawings on its own thread, so the frame loop never waits for an encoder or the disk
+# The caller gives snapshots (a TiledCanvas copy is copy-on-write, an image is copied), they are never changed again
+# At most max_pending saves wait in the queue, when it is full the save is skipped instead of blocking
+
+# -----------------------------------------------
+# Autosave directory
+# -----------------------------------------------
+#   canvas.json      -> size, background, tiles that exist, view and the settings needed to resume
+#   tiles/X_Y.z      -> zlib compressed pixels of every tile, only the changed ones are written again
+#   log.npy          -> stroke log commands, so undo still works after resuming
+
+def _write_atomic(path, data):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path) #A crash never leaves half a file
+
+def _tile_path(directory, key):
+    return os.path.join(directory, 'tiles', f'{key[0]}_{key[1]}.z')
+
+# The tiles of a snapshot: the ones of a TiledCanvas (array or compressed bytes), or pieces of an image
+def _snapshot_tiles(image):
+    if isinstance(image, TiledCanvas):
+        return image.tiles
+    h, w = image.shape[:2]
+    return {(tx, ty): image[ty * TILE_SIZE:(ty + 1) * TILE_SIZE, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+            for ty in range(-(-h // TILE_SIZE)) for tx in range(-(-w // TILE_SIZE))}
+
+# What is compared with the last autosave: the version of a TiledCanvas tile (None if it was loaded and never drawn on),
+# the pixels of a piece of an image
+def _tile_stamp(image, key, tile):
+    if isinstance(image, TiledCanvas):
+        return image.versions.get(key)
+    return tile
+
+def _tile_changed(stamp, previous, tiled):
+    if tiled:
+        return stamp != previous #Compressing a tile makes a new object, but keeps its version
+    return not np.array_equal(stamp, previous) #Piece of an image, the pixels are compared
+
+class BackgroundSaver:
+    def __init__(self, autosave_dir=None, autosave_interval=10.0, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.autosave_dir = autosave_dir
+        self.autosave_interval = autosave_interval
+        self.last_autosave = time.perf_counter()
+        self.previous_tiles = {} #Stamps of the tiles of the last autosave, only used by the thread
+
+        #....Statistics....
+        self.saved = 0
+        self.autosaves = 0
+        self.tiles_written = 0
+        self.skipped = 0
+
+        self.thread = threading.Thread(target=self._loop, name='BackgroundSaver', daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as error:
+                print(f'Saving failed: {error}')
+
+    # block=True waits for room in the queue instead of skipping, for a save that must not be lost
+    def _submit(self, job, block=False):
+        try:
+            self.queue.put(job, block=block)
+            return True
+        except queue.Full:
+            self.skipped += 1
+            return False
+
+    # Saves the drawing as an image, and the stroke log (commands, base) if given
+    def save_drawing(self, path, image, log=None):
+        def job():
+            cv2.imwrite(path + '.png', image if isinstance(image, np.ndarray) else image.to_image())
+            if log is not None:
+                save_log(path + '.npz', *log) #Can be rendered again with stroke_log.py
+            self.saved += 1
+        return self._submit(job)
+
+    def autosave_due(self):
+        return self.autosave_dir is not None and time.perf_counter() - self.last_autosave >= self.autosave_interval
+
+    # Writes the tiles that changed since the last autosave, settings is saved as it is in canvas.json
+    # The last autosave (e.g. when quitting) is given with block=True
+    def autosave(self, image, commands=None, settings=None, block=False):
+        self.last_autosave = time.perf_counter()
+        return self._submit(lambda: self._autosave(image, commands, settings or {}), block)
+
+    def _autosave(self, image, commands, settings):
+        os.makedirs(os.path.join(self.autosave_dir, 'tiles'), exist_ok=True)
+        tiled = isinstance(image, TiledCanvas)
+        tiles = _snapshot_tiles(image)
+        stamps = {key: _tile_stamp(image, key, tile) for key, tile in tiles.items()}
+        for key, tile in tiles.items():
+            if key in self.previous_tiles and not _tile_changed(stamps[key], self.previous_tiles[key], tiled):
+                continue
+            data = tile if isinstance(tile, bytes) else zlib.compress(np.ascontiguousarray(tile).tobytes(), 1)
+            _write_atomic(_tile_path(self.autosave_dir, key), data)
+            self.tiles_written += 1
+        for key in self.previous_tiles.keys() - tiles.keys():
+            os.remove(_tile_path(self.autosave_dir, key)) #Erased, e.g. after a clear
+        self.previous_tiles = stamps
+
+        if commands is not None:
+            temporary = os.path.join(self.autosave_dir, 'log.tmp.npy')
+            np.save(temporary, commands)
+            os.replace(temporary, os.path.join(self.autosave_dir, 'log.npy'))
+        h, w = image.shape[:2]
+        meta = {'kind': 'tiled' if tiled else 'image', 'width': w, 'height': h,
+                'tile_size': image.tile_size if tiled else TILE_SIZE, 'tiles': [list(key) for key in tiles], **settings}
+        if tiled:
+            meta['background'] = list(image.background)
+        _write_atomic(os.path.join(self.autosave_dir, 'canvas.json'), json.dumps(meta).encode())
+        self.autosaves += 1
+
+    # Waits for the saves in the queue and stops the thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {'saved': self.saved, 'autosaves': self.autosaves, 'tiles_written': self.tiles_written, 'skipped': self.skipped}
+
+# Reads an autosave, returns None if there is none
+# A tiled canvas keeps the tiles compressed, they are only uncompressed when they are shown or drawn on
+def load_autosave(directory):
+    meta_path = os.path.join(directory, 'canvas.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as file:
+        meta = json.load(file)
+
+    t = meta['tile_size']
+    if meta['kind'] == 'tiled':
+        image = TiledCanvas(meta['width'], meta['height'], meta['background'], t)
+        for key in meta['tiles']:
+            with open(_tile_path(directory, key), 'rb') as file:
+                image.tiles[tuple(key)] = file.read()
+    else:
+        image = np.empty((meta['height'], meta['width'], 3), np.uint8)
+        for tx, ty in meta['tiles']:
+            with open(_tile_path(directory, (tx, ty)), 'rb') as file:
+                piece = image[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+                piece[:] = np.frombuffer(zlib.decompress(file.read()), np.uint8).reshape(piece.shape)
+
+    log_path = os.path.join(directory, 'log.npy')
+    commands = np.load(log_path) if os.path.exists(log_path) else None
+    return {'meta': meta, 'image': image, 'commands': commands}
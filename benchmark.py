@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from functions import *
+from tracking import create_tracker, track_marker, find_largest_blob, highlight_blob, find_pen_blobs
+from stroke_log import StrokeLog
+from color_classifier import make_pen, compile_pens, classify, pen_mask
+from functools import partial
+from buffer_pool import frame_buffers
+
+RESOLUTIONS = {'480p': (640, 480), '720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+MODES = ('whiteboard', 'camera_stream', 'paint_by_number', 'tiled_8k')
+STAGES = ('classify', 'pen_blobs', 'threshold', 'components', 'tracking', 'highlight', 'draw', 'composite', 'score')
+
+#Same limits as limits.json, the marker color is inside them and the background is not
+PEN = make_pen('red', 'BGR', {'B': {'min': 0, 'max': 163}, 'G': {'min': 0, 'max': 151}, 'R': {'min': 243, 'max': 255}})
+#Two more pens so classify shows the cost of several pens, the green one sometimes touches the red marker
+EXTRA_PENS = [make_pen('green', 'BGR', {'B': {'min': 0, 'max': 100}, 'G': {'min': 200, 'max': 255}, 'R': {'min': 0, 'max': 100}}, index=1),
+              make_pen('blue', 'HSV', {'H': {'min': 100, 'max': 130}, 'S': {'min': 150, 'max': 255}, 'V': {'min': 150, 'max': 255}}, index=2)]
+MARKER_COLOR = (40, 40, 250)
+SECOND_MARKER_COLOR = (40, 240, 40)
+
+# Creates camera-like frames with a red marker moving around, and sometimes a bigger one in a corner
+class SyntheticCamera:
+    def __init__(self, w, h, seed=0):
+        rng = np.random.default_rng(seed)
+        self.w, self.h = w, h
+        self.background = rng.integers(0, 120, (h, w, 3), dtype=np.uint8)
+        self.radius = max(8, w // 60)
+        self.index = 0
+        self.touching = False #The last frame has a second pen touching the marker
+
+    def position(self, i):
+        x = self.w / 2 + 0.4 * self.w * np.sin(i / 23)
+        y = self.h / 2 + 0.4 * self.h * np.sin(i / 37 + 1)
+        return int(x), int(y)
+
+    def read(self, image=None):
+        #Like the camera, the frame array is reused when one is given
+        frame = image if image is not None else np.empty_like(self.background)
+        np.copyto(frame, self.background)
+        #The marker disappears for a while to exercise the search after the pen is lost
+        if self.index % 200 < 190:
+            cv2.circle(frame, self.position(self.index), self.radius, MARKER_COLOR, -1)
+        #A bigger blob far from the tracked one, the tracker has to switch to it like a full frame search
+        if self.index % 200 in range(100, 130):
+            cv2.circle(frame, (2 * self.radius + 5, 2 * self.radius + 5), 2 * self.radius, MARKER_COLOR, -1)
+        #Another pen right next to the marker, like two people drawing close together
+        self.touching = self.index % 200 in range(150, 180)
+        if self.touching:
+            x, y = self.position(self.index)
+            cv2.circle(frame, (x + 2 * self.radius, y), self.radius, SECOND_MARKER_COLOR, -1)
+        self.index += 1
+        return True, frame
+
+# Keeps the duration (and allocated bytes) of every stage
+class StageTimer:
+    def __init__(self, trace_allocations):
+        self.trace_allocations = trace_allocations
+        self.times = {stage: [] for stage in STAGES}
+        self.allocations = {stage: [] for stage in STAGES}
+        self.frame_allocations = [] #Bytes still allocated or peak of the whole frame
+        self.gc_collections = 0
+        self.pool_allocations = 0
+        self.tracking_mismatches = 0 #Frames where the tracker found another blob than the full frame search
+        self.lost_pens = 0 #Frames with touching pens where find_pen_blobs didn't find both of them
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self.gc_collections += 1
+
+    def start(self):
+        gc.callbacks.append(self._gc_callback)
+        self.pool_allocations = frame_buffers.allocations
+
+    def stop(self):
+        gc.callbacks.remove(self._gc_callback)
+        self.pool_allocations = frame_buffers.allocations - self.pool_allocations
+
+    def start_frame(self):
+        if self.trace_allocations:
+            tracemalloc.clear_traces()
+            self.frame_start = tracemalloc.get_traced_memory()[0]
+
+    def end_frame(self):
+        if self.trace_allocations:
+            self.frame_allocations.append(tracemalloc.get_traced_memory()[0] - self.frame_start)
+
+    def run(self, stage, function, *args):
+        if self.trace_allocations:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function(*args)
+        self.times[stage].append(time.perf_counter() - start)
+        if self.trace_allocations:
+            self.allocations[stage].append(tracemalloc.get_traced_memory()[1] - before)
+        return result
+
+# Runs the same stages as the ar_paint main loop, every stage is timed separately
+def run_pipeline(w, h, mode, frames, trace_allocations=False):
+    camera = SyntheticCamera(w, h)
+    if mode == 'camera_stream':
+        canvas = np.ones((h, w, 3), dtype=np.uint8) #"Transparent" board
+    else:
+        canvas = np.ones((h, w, 3), dtype=np.uint8) * 255 #White board
+    drawing_data = create_drawing_data(canvas)
+    drawing_data['drawing_mode'] = 'Line'
+    drawing_data['color'] = (0, 0, 255)
+
+    areas = None
+    if mode == 'paint_by_number':
+        areas = segment_image(drawing_data, h, w, seed=0)
+        drawing_data['score_board'] = np.ones((100, 300, 3), dtype=np.uint8)
+    if mode == 'tiled_8k':
+        create_tiled_canvas(drawing_data, 7680, 4320)
+    default_img = drawing_image(drawing_data).copy()
+    drawing_data['log'] = StrokeLog(default_img)
+    if mode == 'camera_stream':
+        create_ink_layer(drawing_data)
+    tracker = create_tracker()
+    classifier = compile_pens([PEN])
+    all_pens_classifier = compile_pens([PEN] + EXTRA_PENS)
+    segment = partial(pen_mask, classifier=classifier, index=0)
+    timer = StageTimer(trace_allocations)
+
+    if trace_allocations:
+        tracemalloc.start()
+    timer.start()
+    frame = None
+    start = time.perf_counter()
+    for i in range(frames):
+        timer.start_frame()
+        _, frame = camera.read(frame)
+
+        #....Detection, the full frame stages and the tracked one....
+        labels = timer.run('classify', classify, frame, all_pens_classifier)
+        pen_blobs = timer.run('pen_blobs', find_pen_blobs, labels, len(all_pens_classifier['pens']))
+        if camera.touching and (pen_blobs[0] is None or pen_blobs[1] is None):
+            timer.lost_pens += 1
+        mask = timer.run('threshold', segment, frame)
+        full = timer.run('components', find_largest_blob, mask, (0, 0), 4, frame_buffers.get('benchmark_labels', mask.shape, np.int32))
+        blob = timer.run('tracking', track_marker, frame, segment, tracker)
+        if (full is None) != (blob is None) or (blob is not None and blob['center'] != full['center']):
+            timer.tracking_mismatches += 1
+
+        if blob is not None:
+            timer.run('highlight', highlight_blob, frame, blob)
+            center = (int(blob['center'][0]), int(blob['center'][1]))
+            timer.run('draw', draw_pen, drawing_data, center, default_img, i)
+
+        timer.run('composite', compose_canvas, frame, drawing_data, mode == 'camera_stream')
+        if drawing_data['canvas'] is not None:
+            drawing_data['canvas'].compress_cold()
+        if areas is not None:
+            timer.run('score', calculate_score, drawing_data, 1, areas)
+        timer.end_frame()
+    elapsed = time.perf_counter() - start
+    timer.stop()
+    if trace_allocations:
+        tracemalloc.stop()
+    return timer, elapsed
+
+# Draws like the pen does: lines, and every now and then a circle dragged for a few frames
+def draw_pen(drawing_data, center, default_img, i):
+    if i % 60 == 30:
+        pressed_key(ord('o'), drawing_data, default_img, None)
+    elif i % 60 == 50:
+        pressed_key(-1, drawing_data, default_img, None)
+        drawing_data['drawing_mode'] = 'Line'
+
+    if drawing_data['drawing_mode'] == 'Line':
+        draw_line(drawing_data, (drawing_data['previous_x'], drawing_data['previous_y']), center)
+    if drawing_data['drawing'] == False:
+        drawing_data['start_pos'] = center
+    draw_shape(drawing_data)
+    drawing_data['previous_x'], drawing_data['previous_y'] = center
+
+def summarize(timer, elapsed, frames):
+    result = {'fps': frames / elapsed, 'stages': {},
+              'gc_per_frame': timer.gc_collections / frames, 'pool_allocations': timer.pool_allocations,
+              'tracking_mismatches': timer.tracking_mismatches, 'lost_pens': timer.lost_pens}
+    if timer.frame_allocations:
+        #The first frames fill the buffer pool, the rest should not allocate anything
+        result['alloc_kb_per_frame'] = float(np.mean(timer.frame_allocations[len(timer.frame_allocations) // 2:]) / 1024)
+    for stage in STAGES:
+        times = np.array(timer.times[stage]) * 1000
+        if len(times) == 0:
+            continue
+        result['stages'][stage] = {'p50_ms': float(np.percentile(times, 50)),
+                                   'p99_ms': float(np.percentile(times, 99)),
+                                   'calls': len(times)}
+        if timer.allocations[stage]:
+            result['stages'][stage]['alloc_kb'] = float(np.mean(timer.allocations[stage]) / 1024)
+    return result
+
+def print_result(name, result, baseline=None, tolerance=0.1):
+    line = f"{name:<28} {result['fps']:8.1f} fps"
+    if baseline is not None:
+        line += f"   (baseline {baseline['fps']:.1f} fps, {result['fps'] / baseline['fps']:.2f}x)"
+    print(line)
+    line = f"    gc collections {result.get('gc_per_frame', 0):.3f}/frame, pool allocations {result.get('pool_allocations', 0)}"
+    line += f", tracking mismatches {result.get('tracking_mismatches', 0)}, lost touching pens {result.get('lost_pens', 0)}"
+    if 'alloc_kb_per_frame' in result:
+        line += f", steady state {result['alloc_kb_per_frame']:.1f} kB/frame"
+    print(line)
+    for stage, values in result['stages'].items():
+        line = f"    {stage:<12} p50 {values['p50_ms']:8.3f} ms   p99 {values['p99_ms']:8.3f} ms"
+        if 'alloc_kb' in values:
+            line += f"   alloc {values['alloc_kb']:10.1f} kB/call"
+        if baseline is not None and stage in baseline['stages']:
+            ratio = values['p50_ms'] / max(baseline['stages'][stage]['p50_ms'], 1e-9)
+            flag = '  REGRESSION' if ratio > 1 + tolerance else ''
+            line += f"   {ratio:5.2f}x baseline{flag}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the AR Paint frame pipeline stages')
+    parser.add_argument('-r', '--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument('-m', '--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('-f', '--frames', type=int, default=100, help='Frames per configuration')
+    parser.add_argument('-s', '--save_baseline', type=str, help='Save the results as a baseline JSON file')
+    parser.add_argument('-c', '--compare', type=str, help='Compare the results with a baseline JSON file')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, help='Slowdown considered a regression. Default: 0.1 (10%%)')
+    args = vars(parser.parse_args())
+
+    baseline = None
+    if args['compare'] is not None:
+        with open(args['compare'], 'r') as file:
+            baseline = json.load(file)
+
+    results = {}
+    for resolution in args['resolutions']:
+        w, h = RESOLUTIONS[resolution]
+        for mode in args['modes']:
+            name = f'{resolution}/{mode}'
+            timer, elapsed = run_pipeline(w, h, mode, args['frames'])
+            result = summarize(timer, elapsed, args['frames'])
+
+            #Allocations are measured in a second run, tracemalloc slows everything down
+            alloc_frames = min(args['frames'], 30)
+            alloc_timer, _ = run_pipeline(w, h, mode, alloc_frames, trace_allocations=True)
+            alloc_result = summarize(alloc_timer, 1, alloc_frames)
+            result['alloc_kb_per_frame'] = alloc_result['alloc_kb_per_frame']
+            for stage, values in alloc_result['stages'].items():
+                if stage in result['stages']:
+                    result['stages'][stage]['alloc_kb'] = values['alloc_kb']
+
+            results[name] = result
+            print_result(name, result, baseline.get(name) if baseline else None, args['tolerance'])
+
+    if args['save_baseline'] is not None:
+        with open(args['save_baseline'], 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {args['save_baseline']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import numpy as np
+
+# Keeps the arrays used in every frame so they are allocated only once
+# A buffer grows when a bigger one is asked for, smaller requests get a view of it
+class BufferPool:
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0 #How many times a buffer had to be (re)allocated
+
+    def get(self, name, shape, dtype=np.uint8):
+        shape = tuple(int(s) for s in shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.ndim != len(shape) or \
+           any(b < s for b, s in zip(buffer.shape, shape)):
+            if buffer is not None and buffer.dtype == dtype and buffer.ndim == len(shape):
+                shape_to_allocate = tuple(max(b, s) for b, s in zip(buffer.shape, shape))
+            else:
+                shape_to_allocate = shape
+            buffer = np.empty(shape_to_allocate, dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        if buffer.shape == shape:
+            return buffer
+        return buffer[tuple(slice(0, s) for s in shape)]
+
+    def nbytes(self):
+        return sum(b.nbytes for b in self.buffers.values())
+
+#Shared by the whole frame loop
+frame_buffers = BufferPool()
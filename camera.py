@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+# Reads the camera on its own thread and keeps only the newest frames in a small ring buffer
+# Without the thread (threaded=False) every frame is read in order, which is what recorded sources need
+# The frame arrays are recycled: the one returned by read() is reused after the next read()
+class CameraCapture:
+    def __init__(self, source=0, buffer_size=2, threaded=True):
+        if hasattr(source, 'read'):
+            self.vid = source #Any frame source (see frame_sources.py)
+        else:
+            self.vid = cv2.VideoCapture(source)
+        self.vid.set(cv2.CAP_PROP_BUFFERSIZE, 1) #We don't want the driver to queue old frames either
+        self.threaded = threaded
+
+        self.ring = deque(maxlen=buffer_size) #(frame_id, timestamp, frame)
+        self.free = []          #Frame arrays that can be filled again
+        self.in_use = None      #Frame array being used by the main loop
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+        #....Statistics....
+        self.captured = 0       #Frames read from the camera
+        self.delivered = 0      #Frames handed to the main loop
+        self.dropped = 0        #Frames overwritten before the main loop could take them
+        self.latencies = deque(maxlen=300) #Capture to display latency in seconds
+
+    def start(self):
+        #The first frame is read synchronously so the caller can know the frame size
+        ret, frame = self._read_frame()
+        if not ret:
+            return False, None
+        self._push(frame, time.perf_counter())
+
+        self.running = True
+        if not self.threaded:
+            return True, frame
+        self.thread = threading.Thread(target=self._capture_loop, name='CameraCapture', daemon=True)
+        self.thread.start()
+        return True, frame
+
+    # Array where the next frame is read, None if a new one has to be allocated
+    def _next_buffer(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1 #The oldest frame was never taken, its array is reused
+                return self.ring.popleft()[2]
+        return None
+
+    def _read_frame(self):
+        buffer = self._next_buffer()
+        if buffer is None:
+            return self.vid.read()
+        ret, frame = self.vid.read(buffer)
+        if not ret:
+            with self.lock:
+                self.free.append(buffer)
+        return ret, frame
+
+    def _push(self, frame, timestamp):
+        with self.lock:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1 #The oldest frame was never taken
+                self.free.append(self.ring.popleft()[2])
+            self.ring.append((self.captured, timestamp, frame))
+            self.captured += 1
+            self.new_frame.notify()
+
+    def _capture_loop(self):
+        while self.running:
+            ret, frame = self._read_frame()
+            if not ret:
+                #Camera stopped delivering, wake up anybody waiting so they can stop too
+                with self.lock:
+                    self.running = False
+                    self.new_frame.notify_all()
+                break
+            self._push(frame, time.perf_counter())
+
+    # Returns the newest frame and discards the older ones (ret, frame, capture timestamp)
+    def read(self, timeout=1.0):
+        if not self.threaded and not self.ring and self.running:
+            ret, frame = self._read_frame()
+            if not ret:
+                self.running = False
+                return False, None, None
+            self._push(frame, time.perf_counter())
+
+        with self.lock:
+            if not self.ring and self.running:
+                self.new_frame.wait(timeout)
+            if not self.ring:
+                return False, None, None
+
+            _, timestamp, frame = self.ring.pop()
+            self.dropped += len(self.ring) #Older frames are skipped
+            self.free.extend(f for _, _, f in self.ring)
+            self.ring.clear()
+            if self.in_use is not None:
+                self.free.append(self.in_use) #The main loop is done with the previous frame
+            self.in_use = frame
+
+        self.delivered += 1
+        return True, frame, timestamp
+
+    # Must be called once the frame taken with read() has been shown
+    def frame_displayed(self, timestamp):
+        if timestamp is not None:
+            self.latencies.append(time.perf_counter() - timestamp)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'captured': self.captured,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'latency_ms_mean': float(latencies.mean()),
+                'latency_ms_p95': float(np.percentile(latencies, 95))}
+
+    def release(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+        self.vid.release()
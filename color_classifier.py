@@ -0,0 +1,147 @@
+import json
+
+import cv2
+import numpy as np
+
+from buffer_pool import frame_buffers
+
+MAX_PENS = 8 #Every pen is one bit of a uint8
+CHANNELS = {'BGR': ('B', 'G', 'R'), 'HSV': ('H', 'S', 'V')}
+CHANNEL_MAX = {'B': 255, 'G': 255, 'R': 255, 'H': 179, 'S': 255, 'V': 255} #OpenCV hue goes from 0 to 179
+#Drawing colors given to the pens that don't have one
+DEFAULT_COLORS = ((0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0), (0, 128, 255), (128, 0, 255))
+
+# Creates a pen definition: name, color space, {channel: {'min', 'max'}}, the color and thickness it draws with
+def make_pen(name, space, limits, color=None, index=0, thickness=5):
+    if space not in CHANNELS:
+        raise ValueError(f'Unknown color space {space}, use BGR or HSV')
+    for channel in CHANNELS[space]:
+        if channel not in limits:
+            raise ValueError(f'Pen {name} has no limits for channel {channel}')
+    return {'name': name, 'space': space,
+            'limits': {c: {'min': int(limits[c]['min']), 'max': int(limits[c]['max'])} for c in CHANNELS[space]},
+            'color': tuple(color) if color is not None else DEFAULT_COLORS[index % len(DEFAULT_COLORS)],
+            'thickness': int(thickness)}
+
+# Loads the pens from the JSON file
+# Old files only have {'limits': {'B': .., 'G': .., 'R': ..}}, that is one BGR pen
+# New files have {'pens': {name: {'space': 'BGR' or 'HSV', 'limits': {..}, 'color': [b, g, r], 'thickness': t}}}
+def load_pens(json_file):
+    with open(json_file, 'r') as file:
+        data = json.load(file)
+    return pens_from_dict(data)
+
+def pens_from_dict(data):
+    pens = []
+    for i, (name, pen) in enumerate(data.get('pens', {}).items()):
+        pens.append(make_pen(name, pen.get('space', 'BGR'), pen['limits'], pen.get('color'), i, pen.get('thickness', 5)))
+    if not pens and 'limits' in data:
+        pens.append(make_pen('default', 'BGR', data['limits']))
+    if len(pens) > MAX_PENS:
+        raise ValueError(f'At most {MAX_PENS} pens are supported')
+    return pens
+
+def pens_to_dict(pens):
+    data = {'pens': {pen['name']: {'space': pen['space'], 'limits': pen['limits'], 'color': list(pen['color']), 'thickness': pen['thickness']} for pen in pens}}
+    #The first BGR pen is also saved in the old format, so older versions can still read the file
+    for pen in pens:
+        if pen['space'] == 'BGR':
+            data['limits'] = pen['limits']
+            break
+    return data
+
+def save_pens(json_file, pens):
+    with open(json_file, 'w') as file:
+        json.dump(pens_to_dict(pens), file, indent=2)
+
+# Values accepted by one channel, a minimum bigger than the maximum wraps around (useful for the red hue)
+def _channel_range(channel_limits, channel):
+    values = np.arange(CHANNEL_MAX[channel] + 1)
+    low, high = channel_limits['min'], channel_limits['max']
+    if low <= high:
+        accepted = (values >= low) & (values <= high)
+    else:
+        accepted = (values >= low) | (values <= high)
+    lut = np.zeros(256, bool)
+    lut[:len(values)] = accepted
+    return lut
+
+# Turns the pens into lookup tables, only has to be done when the limits change
+# For every color space and channel a 256 entries table gives the bits of the pens that accept each value
+def compile_pens(pens):
+    luts = {}
+    bounds = []
+    for i, pen in enumerate(pens):
+        space = pen['space']
+        if space not in luts:
+            luts[space] = [np.zeros(256, np.uint8) for _ in CHANNELS[space]]
+        for c, channel in enumerate(CHANNELS[space]):
+            luts[space][c][_channel_range(pen['limits'][channel], channel)] |= np.uint8(1 << i)
+
+        #Without hue wrap around a single pen can also be found with cv2.inRange, which is faster
+        limits = [pen['limits'][channel] for channel in CHANNELS[space]]
+        if all(l['min'] <= l['max'] for l in limits):
+            bounds.append((np.array([l['min'] for l in limits], np.uint8), np.array([l['max'] for l in limits], np.uint8)))
+        else:
+            bounds.append(None)
+
+    #Bits to label: the lowest bit set wins, 0 means no pen
+    label_lut = np.zeros(256, np.uint8)
+    for bits in range(1, 256):
+        label_lut[bits] = (bits & -bits).bit_length()
+    label_lut[label_lut > len(pens)] = 0
+
+    #Bits to the mask of a single pen
+    pen_luts = [np.where(np.arange(256) & (1 << i), 255, 0).astype(np.uint8) for i in range(len(pens))]
+    return {'pens': pens, 'luts': luts, 'bounds': bounds, 'label_lut': label_lut, 'pen_luts': pen_luts}
+
+# Bits of the pens that accept every pixel, one pass for all the pens of each color space
+# All the intermediate images are reused buffers, so nothing is allocated in every frame
+def _pen_bits(frame, classifier):
+    shape = frame.shape[:2]
+    bits = frame_buffers.get('classify_bits', shape)
+    space_bits = frame_buffers.get('classify_space_bits', shape)
+    channels = [frame_buffers.get(f'classify_channel_{c}', shape) for c in range(3)]
+    first = True
+    for space, lut in classifier['luts'].items():
+        img = frame if space == 'BGR' else _to_hsv(frame)
+        cv2.split(img, channels)
+        cv2.LUT(channels[0], lut[0], dst=space_bits)
+        for c in (1, 2):
+            cv2.bitwise_and(space_bits, cv2.LUT(channels[c], lut[c], dst=channels[c]), dst=space_bits)
+        if first:
+            np.copyto(bits, space_bits)
+            first = False
+        else:
+            cv2.bitwise_or(bits, space_bits, dst=bits)
+    if first:
+        bits[:] = 0
+    return bits
+
+def _to_hsv(frame):
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=frame_buffers.get('classify_hsv', frame.shape))
+
+# Label image, 0 where there is no pen and i + 1 where pen i is
+# Without dst the result is a reused buffer, only valid until the next call
+def classify(frame, classifier, dst=None):
+    if dst is None:
+        dst = frame_buffers.get('classify_labels', frame.shape[:2])
+    return cv2.LUT(_pen_bits(frame, classifier), classifier['label_lut'], dst=dst)
+
+# Mask (255) of the pixels of a single pen, like cv2.inRange
+# Without dst the result is a reused buffer, only valid until the next call
+def pen_mask(frame, classifier, index=0, dst=None):
+    if dst is None:
+        dst = frame_buffers.get('pen_mask', frame.shape[:2])
+    if classifier['bounds'][index] is not None:
+        lower_bound, upper_bound = classifier['bounds'][index]
+        img = frame if classifier['pens'][index]['space'] == 'BGR' else _to_hsv(frame)
+        return cv2.inRange(img, lower_bound, upper_bound, dst=dst)
+    return cv2.LUT(_pen_bits(frame, classifier), classifier['pen_luts'][index], dst=dst)
+
+# Image where every pen is painted with its color, to preview the classification
+def colorize_labels(labels, classifier):
+    palette = np.zeros((256, 3), np.uint8)
+    for i, pen in enumerate(classifier['pens']):
+        palette[i + 1] = pen['color']
+    return palette[labels]
@@ -1,94 +1,79 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 import cv2
-import numpy as np
 from functools import partial
-import json
+
+from frame_sources import open_frame_source
+from color_classifier import CHANNELS, CHANNEL_MAX, load_pens, save_pens, make_pen, compile_pens, classify, colorize_labels
+
+#....Program arguments....
+parser = argparse.ArgumentParser(description='PSR AR Paint color segmenter')
+parser.add_argument('-src', '--source', type=str, default='0', help='Camera number, video file, image directory or .raw frame dump. Default: camera 0')
+parser.add_argument('-j', '--JSON', type=str, default='limits.json', help='File where the pens are saved. Default: limits.json')
+parser.add_argument('-p', '--pen', type=str, default='default', help='Name of the pen being configured. Default: default')
+parser.add_argument('-s', '--space', type=str, choices=list(CHANNELS), default='BGR', help='Color space of the limits. Default: BGR')
+args = vars(parser.parse_args())
 
 #....Program initialization....
-vid = cv2.VideoCapture(0)
-alpha_slider_max = 255	#Maximum value of the trackbars
+vid = open_frame_source(args['source'])
 title_window = 'frame'
+space = args['space']
+
+#....Pens already saved, the one being configured replaces the one with the same name....
+pens = load_pens(args['JSON']) if os.path.exists(args['JSON']) else []
+pen_index = next((i for i, pen in enumerate(pens) if pen['name'] == args['pen']), len(pens))
+initial_limits = {c: {'min': 100, 'max': CHANNEL_MAX[c]} for c in CHANNELS[space]}
+if pen_index < len(pens) and pens[pen_index]['space'] == space:
+	initial_limits = pens[pen_index]['limits']
+pen_color = pens[pen_index]['color'] if pen_index < len(pens) else None
+
+#....The lookup tables are only compiled again when a trackbar changes....
+state = {'changed': True}
+def on_trackbar(val, state):
+	state['changed'] = True
+
+def current_pens():
+	limits = {c: {'min': cv2.getTrackbarPos(c + ' Min', title_window),
+	              'max': cv2.getTrackbarPos(c + ' Max', title_window)} for c in CHANNELS[space]}
+	pen = make_pen(args['pen'], space, limits, pen_color, pen_index)
+	return pens[:pen_index] + [pen] + pens[pen_index + 1:]
 
-#....Function to generate a thresholded image....
-def on_trackbar(val, channel, image_data):
-	
-	#Translating values
-	min_blue_thr = cv2.getTrackbarPos(b_min_trackbar, title_window)
-	min_green_thr = cv2.getTrackbarPos(g_min_trackbar, title_window)
-	min_red_thr = cv2.getTrackbarPos(r_min_trackbar, title_window)
-	max_blue_thr = cv2.getTrackbarPos(b_max_trackbar, title_window)
-	max_green_thr = cv2.getTrackbarPos(g_max_trackbar, title_window)
-	max_red_thr = cv2.getTrackbarPos(r_max_trackbar, title_window)
-
-	#Appling the threshold
-	_,image_blue = cv2.threshold(image_data['b'], min_blue_thr, max_blue_thr, cv2.THRESH_BINARY)
-	_,image_green = cv2.threshold(image_data['g'], min_green_thr, max_green_thr, cv2.THRESH_BINARY)
-	_,image_red = cv2.threshold(image_data['r'], min_red_thr, max_red_thr, cv2.THRESH_BINARY)
-
-	image_thresholded_2 = cv2.merge((image_blue,image_green,image_red))
 #....Camera initialization....
 ret, frame = vid.read()
 cv2.imshow(title_window, frame)
 
-#....Creating first frame to initialize window and trackbars....
-b ,g ,r = cv2.split(frame)
-image_data={'b':b, 'g':g, 'r':r}
-r_min_trackbar = 'R Min'
-r_max_trackbar = 'R Max'
-g_min_trackbar = 'G Min'
-g_max_trackbar = 'G Max'
-b_min_trackbar = 'B Min'
-b_max_trackbar = 'B Max'
-
-cv2.createTrackbar(r_min_trackbar, title_window, 100, alpha_slider_max, partial(on_trackbar, channel='Rmin',image_data=image_data))
-cv2.createTrackbar(r_max_trackbar, title_window, 255, alpha_slider_max, partial(on_trackbar, channel='Rmax',image_data=image_data))
-cv2.createTrackbar(g_min_trackbar, title_window, 100, alpha_slider_max, partial(on_trackbar, channel='Gmin',image_data=image_data))
-cv2.createTrackbar(g_max_trackbar, title_window, 255, alpha_slider_max, partial(on_trackbar, channel='Gmax',image_data=image_data))
-cv2.createTrackbar(b_min_trackbar, title_window, 100, alpha_slider_max, partial(on_trackbar, channel='Bmin',image_data=image_data))
-cv2.createTrackbar(b_max_trackbar, title_window, 255, alpha_slider_max, partial(on_trackbar, channel='Bmax',image_data=image_data))
+#....Creating the trackbars, a minimum bigger than the maximum wraps around (red hue)....
+for channel in CHANNELS[space]:
+	cv2.createTrackbar(channel + ' Min', title_window, initial_limits[channel]['min'], CHANNEL_MAX[channel], partial(on_trackbar, state=state))
+	cv2.createTrackbar(channel + ' Max', title_window, initial_limits[channel]['max'], CHANNEL_MAX[channel], partial(on_trackbar, state=state))
 
 while (True):
 	#....Updating Camera....
 	ret, frame = vid.read()
-	
-	b ,g ,r = cv2.split(frame)
-	image_data={'b':b, 'g':g, 'r':r}
-
-	#....Fetching the trackbar values....
-	min_blue_thr = cv2.getTrackbarPos(b_min_trackbar, title_window)
-	min_green_thr = cv2.getTrackbarPos(g_min_trackbar, title_window)
-	min_red_thr = cv2.getTrackbarPos(r_min_trackbar, title_window)
-	max_blue_thr = cv2.getTrackbarPos(b_max_trackbar, title_window)
-	max_green_thr = cv2.getTrackbarPos(g_max_trackbar, title_window)
-	max_red_thr = cv2.getTrackbarPos(r_max_trackbar, title_window)
-
-	#....Creating the mask....
-	lower_bound = np.array([min_blue_thr, min_green_thr, min_red_thr], dtype=np.uint8)
-	upper_bound = np.array([max_blue_thr, max_green_thr, max_red_thr], dtype=np.uint8)
-
-	mask = cv2.inRange(frame, lower_bound, upper_bound)
-
-	#....Showing the mask and the camera feedback....
-	cv2.imshow('Thresholded Image', mask)
+	if not ret:
+		print('No more frames') #Feedback
+		break
+
+	#....Compiling the pens when the limits change....
+	if state['changed']:
+		state['changed'] = False
+		classifier = compile_pens(current_pens())
+
+	#....Creating the label image, every pen in its color....
+	labels = classify(frame, classifier)
+
+	#....Showing the pens and the camera feedback....
+	cv2.imshow('Thresholded Image', colorize_labels(labels, classifier))
 	cv2.imshow(title_window, frame)
-	
+
 	#.... Awaiting key to save or quit the program....
 	k = cv2.waitKey(1)
 	if k == ord('w'):
-		#Writing the dictionary
-		limits = {
-            'limits': {
-                'B': {'min': cv2.getTrackbarPos(b_min_trackbar, title_window),
-                      'max': cv2.getTrackbarPos(b_max_trackbar, title_window)},
-                'G': {'min': cv2.getTrackbarPos(g_min_trackbar, title_window),
-                      'max': cv2.getTrackbarPos(g_max_trackbar, title_window)},
-                'R': {'min': cv2.getTrackbarPos(r_min_trackbar, title_window),
-                      'max': cv2.getTrackbarPos(r_max_trackbar, title_window)}}
-            }
-		#Saving the values in json type
-		with open('limits.json', 'w') as file:
-			json.dump(limits, file)
+		#Saving the values in json type, the other pens are kept
+		pens = current_pens()
+		save_pens(args['JSON'], pens)
 
 		print('Values Saved') #Feedback
 
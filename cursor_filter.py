@@ -0,0 +1,109 @@
+import math
+
+import cv2
+import numpy as np
+
+# Filters for the pen position, every one has update((x, y), t) -> (x, y, vx, vy) and reset()
+# The times are in seconds and the velocities in pixels per second
+
+# No filtering, the velocity is only the difference with the last position
+class PassThroughFilter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last = None
+
+    def update(self, point, t):
+        x, y = float(point[0]), float(point[1])
+        vx = vy = 0.0
+        if self.last is not None and t > self.last[2]:
+            vx, vy = (x - self.last[0]) / (t - self.last[2]), (y - self.last[1]) / (t - self.last[2])
+        self.last = (x, y, t)
+        return x, y, vx, vy
+
+# One-Euro filter (Casiez et al.): little smoothing when the pen moves fast, a lot when it is almost still
+# min_cutoff removes the jitter of a still pen, beta lowers the lag of a fast one
+class OneEuroFilter:
+    def __init__(self, min_cutoff=1.0, beta=0.05, d_cutoff=1.0):
+        self.min_cutoff, self.beta, self.d_cutoff = min_cutoff, beta, d_cutoff
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.velocity = np.zeros(2)
+        self.t = None
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def update(self, point, t):
+        point = np.array(point, float)
+        if self.position is None or t <= self.t:
+            self.position, self.t = point, t
+            return (*self.position, *self.velocity)
+        dt = t - self.t
+        a = self._alpha(self.d_cutoff, dt)
+        self.velocity = a * (point - self.position) / dt + (1 - a) * self.velocity
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(self.velocity)
+        a = self._alpha(cutoff, dt)
+        self.position = a * point + (1 - a) * self.position
+        self.t = t
+        return (*self.position, *self.velocity)
+
+# Constant velocity Kalman filter, state (x, y, vx, vy)
+# acceleration is how much the velocity is expected to change (px/s^2), noise the error of a measured center (px)
+class KalmanFilter:
+    def __init__(self, acceleration=2000.0, noise=2.0):
+        self.acceleration, self.noise = acceleration, noise
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * noise ** 2
+        self.reset()
+
+    def reset(self):
+        self.t = None
+
+    def update(self, point, t):
+        measurement = np.array(point, np.float32).reshape(2, 1)
+        if self.t is None or t <= self.t:
+            self.kalman.statePost = np.array([[point[0]], [point[1]], [0], [0]], np.float32)
+            self.kalman.errorCovPost = np.diag([self.noise ** 2, self.noise ** 2, 1e6, 1e6]).astype(np.float32)
+            self.t = t
+            return float(point[0]), float(point[1]), 0.0, 0.0
+
+        #The matrices depend on the time since the last measurement, frames don't come at a fixed rate
+        dt = t - self.t
+        self.kalman.transitionMatrix = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]], np.float32)
+        q = self.acceleration ** 2
+        block = np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]]) * q
+        process_noise = np.zeros((4, 4))
+        process_noise[np.ix_([0, 2], [0, 2])] = block
+        process_noise[np.ix_([1, 3], [1, 3])] = block
+        self.kalman.processNoiseCov = process_noise.astype(np.float32)
+        self.kalman.predict()
+        state = self.kalman.correct(measurement).ravel()
+        self.t = t
+        return float(state[0]), float(state[1]), float(state[2]), float(state[3])
+
+FILTERS = {'none': PassThroughFilter, 'one_euro': OneEuroFilter, 'kalman': KalmanFilter}
+
+def create_cursor_filter(name):
+    if name not in FILTERS:
+        raise ValueError(f'Unknown cursor filter {name}, use one of {", ".join(FILTERS)}')
+    return FILTERS[name]()
+
+# Points between two positions of the pen, following its velocity at both ends (cubic Hermite curve)
+# Used to fill the frames where the pen wasn't found, the end point is not included
+def interpolate_gap(start, start_velocity, end, end_velocity, duration, steps):
+    p0, p1 = np.array(start, float), np.array(end, float)
+    m0, m1 = np.array(start_velocity, float) * duration, np.array(end_velocity, float) * duration
+    points = []
+    for i in range(1, steps):
+        s = i / steps
+        h00, h10, h01, h11 = 2 * s ** 3 - 3 * s ** 2 + 1, s ** 3 - 2 * s ** 2 + s, -2 * s ** 3 + 3 * s ** 2, s ** 3 - s ** 2
+        x, y = h00 * p0 + h10 * m0 + h01 * p1 + h11 * m1
+        points.append((int(x), int(y)))
+    return points
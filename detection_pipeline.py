@@ -0,0 +1,218 @@
+import multiprocessing
+import queue
+import signal
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from frame_sources import open_frame_source
+from color_classifier import pens_from_dict, pens_to_dict, compile_pens, pen_mask, classify
+from tracking import create_tracker, track_marker, find_pen_blobs
+
+# Capture and detection run in a worker process, so they use another core than the drawing and the windows
+# The frames are written in a ring of shared memory slots (nothing is pickled), only the blobs come back
+# A slot goes around: free -> filled and detected by the worker -> used by the UI -> free when the UI reads the next frame
+# When every slot is taken the UI is behind: a live camera drops the frame, a file waits (backpressure)
+
+# Only the numbers of a blob are sent back, the label image stays in the worker
+def _blob_record(blob):
+    if blob is None:
+        return None
+    return (blob['center'], blob['bbox'], blob['area'])
+
+def _blob_from_record(record):
+    if record is None:
+        return None
+    center, bbox, area = record
+    return {'center': center, 'bbox': bbox, 'area': area, 'labels': None, 'idx': None, 'offset': (0, 0)}
+
+# Same detection as the ar_paint main loop: the tracked pen, or every pen from one label image
+def _create_detector(pens, multi_pen):
+    if multi_pen:
+        classifier = compile_pens(pens)
+        return lambda frame: [_blob_record(b) for b in find_pen_blobs(classify(frame, classifier), len(pens))]
+    classifier = compile_pens(pens[:1])
+    segment = partial(pen_mask, classifier=classifier, index=0)
+    tracker = create_tracker()
+    return lambda frame: [_blob_record(track_marker(frame, segment, tracker))]
+
+def _detection_worker(source, pens, multi_pen, drop_frames, commands, free_slots, results, stop):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl-C reaches every process, the UI stops the worker with stop
+    vid = open_frame_source(source)
+    ret, first_frame = vid.read()
+    if not ret:
+        results.put(('end',))
+        return
+    #The UI creates the shared memory once it knows the frame size
+    results.put(('shape', first_frame.shape))
+    name, num_slots = commands.get()
+    memory = shared_memory.SharedMemory(name=name)
+    slots = np.ndarray((num_slots,) + first_frame.shape, np.uint8, buffer=memory.buf)
+    detect = _create_detector(pens_from_dict(pens), multi_pen)
+
+    pending = first_frame #Read before the slots existed
+    scratch = np.empty_like(first_frame) #Where the dropped frames are read
+    target = frame = None
+    frame_id, dropped = 0, 0
+    try:
+        while not stop.is_set():
+            try:
+                if drop_frames and pending is None:
+                    slot = free_slots.get_nowait()
+                else:
+                    slot = free_slots.get(timeout=0.1)
+            except queue.Empty:
+                if drop_frames and pending is None:
+                    #The camera is still read, so the next frame is a new one and not an old one from the driver
+                    ret, _ = vid.read(scratch)
+                    if not ret: break
+                    dropped += 1
+                continue
+
+            target = slots[slot]
+            if pending is not None:
+                target[:] = pending
+                ret, pending = True, None
+            else:
+                ret, frame = vid.read(target)
+                if ret and not np.may_share_memory(frame, target):
+                    target[:] = frame #The source couldn't read into the slot
+            if not ret:
+                break
+            timestamp = time.perf_counter()
+            blobs = detect(target)
+            results.put(('frame', slot, frame_id, timestamp, blobs, time.perf_counter() - timestamp, dropped))
+            frame_id += 1
+    finally:
+        results.put(('end',))
+        del slots, target, frame
+        _close_memory(memory)
+        vid.release()
+
+# Closing fails while some array still uses the memory, it is then freed when the process ends
+def _close_memory(memory):
+    try:
+        memory.close()
+    except BufferError:
+        pass
+
+# Used like CameraCapture, read() also leaves the blobs of the frame in self.blobs
+class DetectionPipeline:
+    def __init__(self, source, pens, multi_pen=False, num_slots=4, drop_frames=True):
+        context = multiprocessing.get_context('spawn') #A clean process, forking with OpenCV threads can hang
+        self.commands, self.free_slots, self.results = context.Queue(), context.Queue(), context.Queue()
+        self.stop = context.Event()
+        self.process = context.Process(target=_detection_worker, name='DetectionPipeline', daemon=True,
+                                       args=(str(source), pens_to_dict(pens), multi_pen, drop_frames,
+                                             self.commands, self.free_slots, self.results, self.stop))
+        self.num_slots = num_slots
+        self.drop_frames = drop_frames
+        self.memory = None
+        self.slots = None
+        self.pending = deque() #(slot, timestamp, blobs, detection time) not taken by the UI yet
+        self.in_use = None     #Slot being used by the UI
+        self.running = False
+        self.blobs = []
+        self.detection_time = 0.0
+
+        #....Statistics....
+        self.captured = 0
+        self.delivered = 0
+        self.dropped = 0        #Frames skipped by the UI
+        self.worker_dropped = 0 #Frames the worker had no free slot for
+        self.latencies = deque(maxlen=300)
+
+    def start(self, timeout=30.0):
+        self.process.start()
+        try:
+            message = self.results.get(timeout=timeout) #Opening a camera can take a while
+        except queue.Empty:
+            message = ('end',)
+        if message[0] != 'shape':
+            self.release()
+            return False, None
+        shape = message[1]
+        self.memory = shared_memory.SharedMemory(create=True, size=self.num_slots * int(np.prod(shape)))
+        self.slots = np.ndarray((self.num_slots,) + tuple(shape), np.uint8, buffer=self.memory.buf)
+        self.commands.put((self.memory.name, self.num_slots))
+        for slot in range(self.num_slots):
+            self.free_slots.put(slot)
+
+        #The first frame is also given by the first read(), like CameraCapture
+        self.running = True
+        if not self._receive(timeout):
+            self.release()
+            return False, None
+        return True, self.slots[self.pending[0][0]]
+
+    # Waits for the next message of the worker, returns False if there was no frame
+    def _receive(self, timeout=None):
+        try:
+            message = self.results.get(timeout=timeout) if timeout is not None else self.results.get_nowait()
+        except queue.Empty:
+            return False
+        if message[0] == 'end':
+            self.running = False
+            return False
+        _, slot, frame_id, timestamp, blobs, detection_time, worker_dropped = message
+        self.pending.append((slot, timestamp, blobs, detection_time))
+        self.captured = frame_id + 1 + worker_dropped
+        self.worker_dropped = worker_dropped
+        return True
+
+    # Returns the newest detected frame (ret, frame, capture timestamp), the frame stays valid until the next read
+    def read(self, timeout=1.0):
+        if not self.pending and self.running:
+            self._receive(timeout)
+        if self.drop_frames:
+            while self.running and self._receive():
+                pass
+            while len(self.pending) > 1:
+                self.free_slots.put(self.pending.popleft()[0]) #Older frames are skipped
+                self.dropped += 1
+        if not self.pending:
+            return False, None, None
+
+        slot, timestamp, blobs, self.detection_time = self.pending.popleft()
+        if self.in_use is not None:
+            self.free_slots.put(self.in_use) #The UI is done with the previous frame
+        self.in_use = slot
+        self.blobs = [_blob_from_record(b) for b in blobs]
+        self.delivered += 1
+        return True, self.slots[slot], timestamp
+
+    # Must be called once the frame taken with read() has been shown
+    def frame_displayed(self, timestamp):
+        if timestamp is not None:
+            self.latencies.append(time.perf_counter() - timestamp)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'captured': self.captured,
+                'delivered': self.delivered,
+                'dropped': self.dropped + self.worker_dropped,
+                'latency_ms_mean': float(latencies.mean()),
+                'latency_ms_p95': float(np.percentile(latencies, 95))}
+
+    def release(self):
+        self.running = False
+        self.stop.set()
+        #The worker can't finish while its last messages are in the queue, so they are read
+        deadline = time.perf_counter() + 2.0
+        while self.process.is_alive() and time.perf_counter() < deadline:
+            try:
+                self.results.get(timeout=0.05)
+            except queue.Empty:
+                pass
+            self.process.join(timeout=0.01)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        if self.memory is not None:
+            self.slots = None
+            _close_memory(self.memory) #The last frame read may still be used by the caller
+            self.memory.unlink()
+            self.memory = None
@@ -0,0 +1,111 @@
+import cv2
+import numpy as np
+
+# All the windows of ar_paint: every view is pushed with show() and only reaches the screen when it changed
+# The windows are created and placed once, the first time they are shown
+# tiled=True puts every view in one window, headless=True does no GUI work at all (no windows, no images prepared)
+
+WINDOW_POSITIONS = {'Camera Feedback': (40, 10), 'Biggest Area Highlight': (40, 850), 'canvas': (800, 300), 'Score': (800, 10)}
+MOSAIC_LAYOUT = [['Camera Feedback', 'canvas'], ['Biggest Area Highlight', 'Score']]
+MOSAIC_WINDOW = 'AR Paint'
+MOSAIC_BACKGROUND = (32, 32, 32)
+
+class DisplayManager:
+    # frame_size is the size of the camera views, used to lay out the tiled window
+    def __init__(self, frame_size, headless=False, tiled=False, max_width=1920):
+        self.headless = headless
+        self.tiled = tiled and not headless
+        self.windows = set()        #Windows already created and placed
+        self.shown = {}             #View -> (image id, version) of what is on the screen
+        self.mouse_callbacks = {}   #View -> callback with the coordinates of that view
+
+        #....Tiled window, every view in a cell of the size of a camera frame....
+        if self.tiled:
+            w, h = frame_size
+            columns, rows = max(len(row) for row in MOSAIC_LAYOUT), len(MOSAIC_LAYOUT)
+            self.scale = min(1.0, max_width / (columns * w))
+            cw, ch = int(w * self.scale), int(h * self.scale)
+            self.cells = {name: (c * cw, r * ch, cw, ch) for r, row in enumerate(MOSAIC_LAYOUT) for c, name in enumerate(row)}
+            self.mosaic = np.full((rows * ch, columns * cw, 3), MOSAIC_BACKGROUND, np.uint8)
+            self.mosaic_changed = False
+
+        #....Statistics....
+        self.pushed = 0
+        self.skipped = 0
+
+    # Events of the window (or of the cell of the tiled window) are given to callback in the coordinates of the view
+    def set_mouse_callback(self, name, callback):
+        if self.headless:
+            return
+        self.mouse_callbacks[name] = callback
+        if self.tiled:
+            self._window(MOSAIC_WINDOW)
+        elif name in self.windows:
+            cv2.setMouseCallback(name, callback)
+
+    def _window(self, name):
+        if name in self.windows:
+            return
+        cv2.namedWindow(name)
+        cv2.moveWindow(name, *WINDOW_POSITIONS.get(name, (0, 0)))
+        if name == MOSAIC_WINDOW:
+            cv2.setMouseCallback(name, self._mosaic_mouse)
+        elif name in self.mouse_callbacks:
+            cv2.setMouseCallback(name, self.mouse_callbacks[name])
+        self.windows.add(name)
+
+    def _mosaic_mouse(self, event, x, y, flags, *userdata):
+        for name, callback in self.mouse_callbacks.items():
+            cx, cy, cw, ch = self.cells[name]
+            if cx <= x < cx + cw and cy <= y < cy + ch:
+                callback(event, int((x - cx) / self.scale), int((y - cy) / self.scale), flags, *userdata)
+
+    # Pushes a view, version says when it changed: the same image with the same version is not shown again
+    # version=None is a view that changes every frame. prepare(img) is only called when the view is really shown
+    def show(self, name, img, version=None, prepare=None):
+        if self.headless:
+            return False
+        key = (id(img), version)
+        if version is not None and self.shown.get(name) == key:
+            self.skipped += 1
+            return False
+        self.shown[name] = key
+        if prepare is not None:
+            img = prepare(img)
+        if self.tiled:
+            self._paste(name, img)
+        else:
+            self._window(name)
+            cv2.imshow(name, img)
+        self.pushed += 1
+        return True
+
+    def _paste(self, name, img):
+        cx, cy, cw, ch = self.cells[name]
+        h, w = min(ch, int(img.shape[0] * self.scale)), min(cw, int(img.shape[1] * self.scale))
+        target = self.mosaic[cy:cy + h, cx:cx + w]
+        if self.scale == 1.0:
+            target[:] = img[:h, :w]
+        else:
+            cv2.resize(img[:int(h / self.scale), :int(w / self.scale)], (w, h), dst=target, interpolation=cv2.INTER_AREA)
+        self.mosaic_changed = True
+
+    # Shows the tiled window once per frame, after all its views were pushed
+    def flush(self):
+        if self.tiled and self.mosaic_changed:
+            self._window(MOSAIC_WINDOW)
+            cv2.imshow(MOSAIC_WINDOW, self.mosaic)
+            self.mosaic_changed = False
+
+    # Updates the windows and returns the key pressed, nothing to update when headless
+    def wait_key(self, delay=1):
+        if self.headless:
+            return -1
+        return cv2.waitKey(delay)
+
+    def stats(self):
+        return {'pushed': self.pushed, 'skipped': self.skipped}
+
+    def close(self):
+        if self.windows:
+            cv2.destroyAllWindows()
@@ -0,0 +1,180 @@
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+RAW_EXTENSION = '.raw'
+
+# All the frame sources can be used like a cv2.VideoCapture (read, set, release)
+# read(image) fills image when it can, so the frame arrays can be reused
+
+# Reads the images of a directory in alphabetical order
+class ImageSequenceSource:
+    def __init__(self, directory):
+        self.paths = sorted(p for p in glob.glob(os.path.join(directory, '*')) if p.lower().endswith(IMAGE_EXTENSIONS))
+        self.index = 0
+
+    def read(self, image=None):
+        if self.index >= len(self.paths):
+            return False, None
+        frame = cv2.imread(self.paths[self.index], cv2.IMREAD_COLOR)
+        self.index += 1
+        return frame is not None, frame
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        self.index = len(self.paths)
+
+# Reads frames from a raw dump without decoding anything, the file is memory-mapped
+class RawFrameSource:
+    def __init__(self, path):
+        with open(raw_meta_path(path), 'r') as file:
+            meta = json.load(file)
+        shape = tuple(meta['shape'])
+        frame_size = int(np.prod(shape))
+        count = os.path.getsize(path) // frame_size
+        self.frames = np.memmap(path, dtype=np.uint8, mode='r', shape=(count,) + shape) if count > 0 else np.zeros((0,) + shape, np.uint8)
+        self.index = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read(self, image=None):
+        if self.index >= len(self.frames):
+            return False, None
+        #Copy, so the frame can be changed like a camera frame
+        if image is not None and image.shape == self.frames.shape[1:]:
+            np.copyto(image, self.frames[self.index])
+            frame = image
+        else:
+            frame = np.array(self.frames[self.index])
+        self.index += 1
+        return True, frame
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        self.frames = self.frames[:0]
+
+# Appends frames to a raw dump that RawFrameSource can read
+class RawFrameWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.shape = None
+        self.count = 0
+
+    def write(self, frame):
+        if self.shape is None:
+            self.shape = frame.shape
+            with open(raw_meta_path(self.path), 'w') as file:
+                json.dump({'shape': list(frame.shape), 'dtype': 'uint8'}, file)
+        self.file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.count += 1
+
+    def release(self):
+        self.file.close()
+
+def raw_meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+# Live camera is a number ('0'), a directory is an image sequence, a .raw file is a raw dump, anything else is a video
+def open_frame_source(source):
+    source = str(source)
+    if source.isdigit():
+        return cv2.VideoCapture(int(source))
+    elif os.path.isdir(source):
+        return ImageSequenceSource(source)
+    elif source.endswith(RAW_EXTENSION):
+        return RawFrameSource(source)
+    return cv2.VideoCapture(source)
+
+def is_live_source(source):
+    return str(source).isdigit()
+
+# -----------------------------------------------
+# Session recording and replay
+# -----------------------------------------------
+# A session directory has:
+#   frames.raw + frames.json -> every frame processed by the main loop
+#   events.jsonl             -> keys, mouse events and capture times, with the frame they happened after
+#   session.json             -> program arguments, color limits and random seed
+
+# Saves everything needed to run an ar_paint session again
+class SessionRecorder:
+    def __init__(self, directory, settings):
+        os.makedirs(directory, exist_ok=True)
+        self.start_time = time.perf_counter()
+        self.frames = RawFrameWriter(os.path.join(directory, 'frames' + RAW_EXTENSION))
+        self.events = open(os.path.join(directory, 'events.jsonl'), 'w')
+        with open(os.path.join(directory, 'session.json'), 'w') as file:
+            json.dump(settings, file, indent=2)
+
+    def frame(self, frame, timestamp=None):
+        self.frames.write(frame)
+        if timestamp is not None:
+            #Capture time, the cursor filters depend on it
+            self._event({'type': 'frame', 'capture_t': round(timestamp - self.start_time, 6)})
+
+    def _event(self, event):
+        event['t'] = round(time.perf_counter() - self.start_time, 6)
+        event['frame'] = self.frames.count - 1
+        self.events.write(json.dumps(event) + '\n')
+
+    def key(self, key):
+        if key != -1:
+            self._event({'type': 'key', 'key': key})
+
+    def mouse(self, event, x, y, flags):
+        self._event({'type': 'mouse', 'event': event, 'x': x, 'y': y, 'flags': flags})
+
+    # Mouse callback that saves the event and then calls the real one
+    def mouse_callback(self, callback):
+        def recording_callback(event, x, y, flags, *userdata):
+            self.mouse(event, x, y, flags)
+            callback(event, x, y, flags, *userdata)
+        return recording_callback
+
+    def release(self):
+        self.frames.release()
+        self.events.close()
+
+# Gives back the frames, keys and mouse events of a recorded session
+class SessionReplay:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'session.json'), 'r') as file:
+            self.settings = json.load(file)
+        self.frames_path = os.path.join(directory, 'frames' + RAW_EXTENSION)
+        self.source = RawFrameSource(self.frames_path)
+
+        self.keys = {}
+        self.mouse = {}
+        self.frame_times = {}
+        with open(os.path.join(directory, 'events.jsonl'), 'r') as file:
+            for line in file:
+                event = json.loads(line)
+                if event['type'] == 'key':
+                    self.keys[event['frame']] = event['key']
+                elif event['type'] == 'frame':
+                    self.frame_times[event['frame']] = event['capture_t']
+                else:
+                    self.mouse.setdefault(event['frame'], []).append((event['event'], event['x'], event['y'], event['flags']))
+
+    # Mouse events (event, x, y, flags) that happened after the frame
+    def mouse_events(self, frame_index):
+        return self.mouse.get(frame_index, [])
+
+    # Capture time of the frame, older sessions without it are taken as 30 fps
+    def frame_time(self, frame_index):
+        return self.frame_times.get(frame_index, frame_index / 30)
+
+    # Key pressed after the frame, -1 if none
+    def key(self, frame_index):
+        return self.keys.get(frame_index, -1)
@@ -1,13 +1,22 @@
-import json
 import cv2
 import numpy as np
 import datetime
-import random
+
+from stroke_log import LINE, COLOR, CLEAR, SHAPE_OPS, make_command
+from instrumentation import timed
+from buffer_pool import frame_buffers
+from cursor_filter import create_cursor_filter, interpolate_gap
+from paint_by_number import create_puzzle
+from tiled_canvas import TiledCanvas, create_viewport, to_canvas, pan_viewport, zoom_viewport, render_viewport
+
+# Creates the dictionary with everything related to the canvas and the pencil
+def create_drawing_data(canvas):
+    return {'img': canvas, 'pencil_down': False, 'previous_x': 0, 'previous_y': 0, 'color': (255, 255, 255), 'thickness': 5, 'drawing': False, 'drawing_mode': None, 'start_pos': (0, 0), 'temp_img': canvas.copy(), 'preview_rect': None,'score_board':None, 'dirty': None, 'log': None, 'ink': None, 'canvas': None, 'view': None, 'saver': None, 'version': 0}
 
 # Mouse callback function to draw
 def mouseCallback(event, x, y, flags, *userdata, drawing_data):
     if drawing_data['drawing_mode'] == 'Line':
-        cv2.line(drawing_data['img'], (drawing_data['previous_x'], drawing_data['previous_y']), (x, y), drawing_data['color'], drawing_data['thickness'])
+        draw_line(drawing_data, (drawing_data['previous_x'], drawing_data['previous_y']), (x, y))
     
     #Keeps changing the starting postition until the figure drawing starts
     if drawing_data['drawing'] == False:
@@ -21,17 +30,255 @@ def mouseCallback(event, x, y, flags, *userdata, drawing_data):
     drawing_data['previous_y'] = y 
 
 
-# Load values from file
-def load_color_limits(json_file):
-    with open(json_file, 'r') as file:
-        limits = json.load(file)
-        color_limits=limits['limits']
-    return color_limits
+# Limits a rectangle (x0, y0, x1, y1) to the image, returns None if nothing is left
+def clip_rect(rect, shape):
+    h, w = shape[:2]
+    x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+    x1, y1 = min(w, int(rect[2])), min(h, int(rect[3]))
+    if x0 < x1 and y0 < y1:
+        return (x0, y0, x1, y1)
+    return None
+
+# Saves the region of the canvas that has changed, only used when someone needs to know (e.g. the score, the ink layer)
+# version changes every time the canvas window image changes, so the window is only updated then
+def mark_dirty(drawing_data, x0, y0, x1, y1):
+    rect = clip_rect((x0, y0, x1, y1), drawing_data['img'].shape)
+    if rect is None: return
+    drawing_data['version'] += 1
+    if drawing_data['dirty'] is not None:
+        drawing_data['dirty'].append(rect)
+    if drawing_data['ink'] is not None:
+        update_ink(drawing_data, rect)
+
+# -----------------------------------------------
+# Ink layer of the "transparent" board
+# -----------------------------------------------
+INK_TILE = 32 #Size of the tiles used to know where there is ink
+
+# Keeps the pixels of the canvas that are not background (mask) and the tiles that have any of them
+def create_ink_layer(drawing_data, background=1):
+    h, w = drawing_data['img'].shape[:2]
+    drawing_data['ink'] = {'background': background,
+                           'mask': np.zeros((h, w), bool),
+                           'tiles': np.zeros((-(-h // INK_TILE), -(-w // INK_TILE)), bool),
+                           'runs': None}
+    update_ink(drawing_data, (0, 0, w, h))
+
+# Updates the ink mask and tiles of a changed rectangle, the rectangle is grown to whole tiles
+def update_ink(drawing_data, rect):
+    ink = drawing_data['ink']
+    t = INK_TILE
+    tx0, ty0, tx1, ty1 = rect[0] // t, rect[1] // t, -(-rect[2] // t), -(-rect[3] // t)
+    x0, y0, x1, y1 = tx0 * t, ty0 * t, tx1 * t, ty1 * t #Slicing stops at the border of the image
+    mask = ink['mask'][y0:y1, x0:x1]
+    np.any(drawing_data['img'][y0:y1, x0:x1] != ink['background'], axis=2, out=mask)
+    rows = np.logical_or.reduceat(mask, np.arange(0, mask.shape[0], t), axis=0)
+    ink['tiles'][ty0:ty1, tx0:tx1] = np.logical_or.reduceat(rows, np.arange(0, mask.shape[1], t), axis=1)
+    ink['runs'] = None
+
+# Horizontal runs of tiles with ink (row, first column, last column + 1), only recalculated after a change
+def ink_runs(ink):
+    if ink['runs'] is None:
+        tiles = ink['tiles']
+        padded = np.zeros((tiles.shape[0], tiles.shape[1] + 2), np.int8)
+        padded[:, 1:-1] = tiles
+        steps = np.diff(padded, axis=1)
+        starts, ends = np.argwhere(steps == 1), np.argwhere(steps == -1)
+        ink['runs'] = [(int(row), int(x0), int(x1)) for (row, x0), (_, x1) in zip(starts, ends)]
+    return ink['runs']
+
+# Copies the pixels of img that have ink (mask) over the frame, inside a rectangle
+def _paint_ink(frame, img, mask, x0, y0, x1, y1):
+    cv2.copyTo(img[y0:y1, x0:x1], mask.view(np.uint8), frame[y0:y1, x0:x1]) #Much faster than np.copyto with where
+
+# Saves what has been drawn in the stroke log, so it can be undone
+def log_command(drawing_data, op, start=(0, 0), end=(0, 0), color=None, thickness=None, pen=''):
+    if drawing_data['log'] is None: return
+    drawing_data['log'].record(drawing_image(drawing_data), op, start, end,
+                               color if color is not None else drawing_data['color'],
+                               thickness if thickness is not None else drawing_data['thickness'], pen)
+
+# -----------------------------------------------
+# Tiled canvas, bigger than the camera
+# -----------------------------------------------
+# The canvas window image (img) is then only the visible part of the tiled canvas, rendered from its tiles
+
+def create_tiled_canvas(drawing_data, width, height):
+    drawing_data['canvas'] = TiledCanvas(width, height)
+    h, w = drawing_data['img'].shape[:2]
+    drawing_data['view'] = create_viewport(drawing_data['canvas'], w, h)
+
+# The image where the drawing is kept and logged: the tiled canvas when there is one, else the canvas window image
+def drawing_image(drawing_data):
+    return drawing_data['canvas'] if drawing_data['canvas'] is not None else drawing_data['img']
+
+def replace_drawing_image(drawing_data, img):
+    if drawing_data['canvas'] is not None:
+        drawing_data['canvas'] = img
+        drawing_data['view']['full'] = True
+    else:
+        drawing_data['img'] = img
+    canvas_replaced(drawing_data)
+
+# The whole drawing as one image, to save it
+def drawing_array(drawing_data):
+    img = drawing_image(drawing_data)
+    return img if isinstance(img, np.ndarray) else img.to_image()
+
+# Gives the saver thread a copy of the drawing (copy-on-write for a tiled canvas) and of its log
+def autosave(saver, drawing_data, settings, block=False):
+    commands = drawing_data['log'].snapshot()[0] if drawing_data['log'] is not None else None
+    view = drawing_data['view']
+    if view is not None:
+        settings = {**settings, 'view': {k: view[k] for k in ('x', 'y', 'scale')}}
+    saver.autosave(drawing_image(drawing_data).copy(), commands, settings, block)
+
+# Draws a command given in window coordinates in the tiled canvas, the thickness is scaled so it looks the same
+def draw_canvas_command(drawing_data, op, start, end, color, thickness, pen=''):
+    view = drawing_data['view']
+    start, end = to_canvas(view, start), to_canvas(view, end)
+    thickness = min(255, max(1, int(round(thickness * view['scale']))))
+    drawing_data['canvas'].render_command(make_command(op, start, end, color, thickness), None)
+    log_command(drawing_data, op, start, end, color, thickness, pen)
+
+# Renders the tiles that changed in the canvas window image, the preview layer gets them too
+def update_view(drawing_data):
+    rects = render_viewport(drawing_data['canvas'], drawing_data['view'], drawing_data['img'])
+    if rects: drawing_data['version'] += 1
+    if drawing_data['drawing'] and rects:
+        for x0, y0, x1, y1 in rects:
+            drawing_data['temp_img'][y0:y1, x0:x1] = drawing_data['img'][y0:y1, x0:x1]
+        draw_shape(drawing_data) #The shape may have been erased
+
+# Has to be called every time the canvas image is replaced (clear, undo...)
+def canvas_replaced(drawing_data):
+    if drawing_data['drawing']: begin_preview(drawing_data)
+    h, w = drawing_data['img'].shape[:2]
+    mark_dirty(drawing_data, 0, 0, w, h)
+
+# Draws a line in the canvas with the current pencil (or with the color and thickness of another pen)
+# pen groups the lines in strokes for undo, every pen of the multi-pen mode has its own
+def draw_line(drawing_data, start, end, color=None, thickness=None, pen=''):
+    color = color if color is not None else drawing_data['color']
+    t = thickness if thickness is not None else drawing_data['thickness']
+    if drawing_data['canvas'] is not None:
+        draw_canvas_command(drawing_data, LINE, start, end, color, t, pen)
+        return
+    cv2.line(drawing_data['img'], start, end, color, t)
+    if drawing_data['drawing']:
+        cv2.line(drawing_data['temp_img'], start, end, color, t) #Else the shape being drawn would erase it when committed
+    log_command(drawing_data, LINE, start, end, color, t, pen)
+    mark_dirty(drawing_data, min(start[0], end[0]) - t, min(start[1], end[1]) - t,
+               max(start[0], end[0]) + t + 1, max(start[1], end[1]) + t + 1)
+
+# Creates the cursor of a pen, it turns the centers found in every frame into the path that is drawn
+# cursor_filter smooths the position and predict_ms draws that far ahead to hide the latency
+# A pen lost for less than max_gap_ms is joined with a curve, a jump bigger than max_jump pixels (shake prevention) starts a new line
+def create_cursor(name='pen', color=None, thickness=None, cursor_filter='none', predict_ms=0, max_gap_ms=150, max_jump=None):
+    return {'name': name, 'color': color, 'thickness': thickness,
+            'filter': create_cursor_filter(cursor_filter), 'predict': predict_ms / 1000, 'max_gap': max_gap_ms / 1000, 'max_jump': max_jump,
+            'previous': None, 'velocity': (0.0, 0.0), 'last_seen': None, 'frame_interval': None}
+
+# Creates the cursor of every pen for the multi-pen mode, each one draws with its own color and thickness
+def create_pen_cursors(pens, **settings):
+    return [create_cursor(pen['name'], pen['color'], pen['thickness'], **settings) for pen in pens]
+
+def end_cursor_line(cursor):
+    cursor['previous'] = None
+    cursor['last_seen'] = None
+    cursor['filter'].reset()
+
+# Moves the cursor to the blob of a new frame (None when the pen isn't seen), t is the capture time in seconds
+# Returns the path to draw: [previous, ..., new position] when the line goes on, [new position] when a new line starts
+def move_pen_cursor(cursor, blob, t):
+    if blob is None:
+        if cursor['last_seen'] is not None and t - cursor['last_seen'] > cursor['max_gap']:
+            end_cursor_line(cursor) #Lost for too long, the next position starts a new line
+        return []
+    if cursor['last_seen'] is not None and t - cursor['last_seen'] > cursor['max_gap']:
+        end_cursor_line(cursor)
+
+    x, y, vx, vy = cursor['filter'].update(blob['center'], t)
+    point = (int(x + vx * cursor['predict']), int(y + vy * cursor['predict']))
+    previous, previous_velocity, last_seen = cursor['previous'], cursor['velocity'], cursor['last_seen']
+    cursor['previous'], cursor['velocity'], cursor['last_seen'] = point, (vx, vy), t
+    if previous is None:
+        return [point]
+
+    #Shake prevention, a jump this big is a detection error and is not drawn
+    if cursor['max_jump'] is not None and max(abs(point[0] - previous[0]), abs(point[1] - previous[1])) > cursor['max_jump']:
+        cursor['filter'].reset()
+        cursor['filter'].update(blob['center'], t)
+        return [point]
+
+    #Frames where the pen wasn't found are filled with a curve that follows the pen velocity
+    dt, interval = t - last_seen, cursor['frame_interval']
+    if interval is not None and dt > 1.5 * interval:
+        return [previous] + interpolate_gap(previous, previous_velocity, point, (vx, vy), dt, int(round(dt / interval))) + [point]
+    cursor['frame_interval'] = dt if interval is None else 0.9 * interval + 0.1 * dt
+    return [previous, point]
+
+# A pen that was lost or jumped starts a new stroke, so undo doesn't remove it with the previous one
+# path is the one returned by move_pen_cursor, pen is the pen of the stroke ('' for the single pen mode)
+def end_pen_stroke(drawing_data, cursor, path, pen=''):
+    if drawing_data['log'] is not None and (len(path) == 1 or cursor['previous'] is None):
+        drawing_data['log'].end_action(pen)
+
+# Draws the path of a pen since the last frame with its own color and thickness, every pen has its own strokes
+def update_pen_cursor(drawing_data, cursor, blob, t):
+    path = move_pen_cursor(cursor, blob, t)
+    end_pen_stroke(drawing_data, cursor, path, cursor['name'])
+    for start, end in zip(path, path[1:]):
+        draw_line(drawing_data, start, end, cursor['color'], cursor['thickness'], cursor['name'])
+
+# Calculates the rectangle (x0, y0, x1, y1) that contains the shape being drawn
+def shape_rect(drawing_data):
+    (sx, sy), px, py, t = drawing_data['start_pos'], drawing_data['previous_x'], drawing_data['previous_y'], drawing_data['thickness']
+    if drawing_data['drawing_mode'] == 'Circle':
+        r = int(np.sqrt((sx - px) ** 2 + (sy - py) ** 2))
+        return (sx - r - t, sy - r - t, sx + r + t + 1, sy + r + t + 1)
+    elif drawing_data['drawing_mode'] == 'Ellipse':
+        ax, ay = abs(px - sx), abs(py - sy)
+        return (sx - ax - t, sy - ay - t, sx + ax + t + 1, sy + ay + t + 1)
+    return (min(sx, px) - t, min(sy, py) - t, max(sx, px) + t + 1, max(sy, py) + t + 1)
+
+# Starts the preview layer of a shape, temp_img is the committed canvas plus the shape being drawn
+def begin_preview(drawing_data):
+    if drawing_data['temp_img'] is None or drawing_data['temp_img'].shape != drawing_data['img'].shape:
+        drawing_data['temp_img'] = drawing_data['img'].copy()
+    else:
+        np.copyto(drawing_data['temp_img'], drawing_data['img']) #Only once per shape
+    drawing_data['preview_rect'] = None
+
+# Erases the last preview by copying back the committed pixels under it
+def restore_preview(drawing_data):
+    rect = drawing_data['preview_rect']
+    if rect is not None:
+        x0, y0, x1, y1 = rect
+        drawing_data['temp_img'][y0:y1, x0:x1] = drawing_data['img'][y0:y1, x0:x1]
+        drawing_data['preview_rect'] = None
+        drawing_data['version'] += 1
+
+# Copies the finished shape from the preview layer to the canvas
+def commit_preview(drawing_data):
+    rect = drawing_data['preview_rect']
+    if rect is not None and drawing_data['canvas'] is not None:
+        #The preview is only in the window, the shape is drawn again in the canvas at its resolution
+        draw_canvas_command(drawing_data, SHAPE_OPS[drawing_data['drawing_mode']], drawing_data['start_pos'],
+                            (drawing_data['previous_x'], drawing_data['previous_y']), drawing_data['color'], drawing_data['thickness'])
+        drawing_data['preview_rect'] = None
+    elif rect is not None:
+        x0, y0, x1, y1 = rect
+        drawing_data['img'][y0:y1, x0:x1] = drawing_data['temp_img'][y0:y1, x0:x1]
+        mark_dirty(drawing_data, *rect)
+        log_command(drawing_data, SHAPE_OPS[drawing_data['drawing_mode']], drawing_data['start_pos'], (drawing_data['previous_x'], drawing_data['previous_y']))
+        drawing_data['preview_rect'] = None
 
 # Draws the shape selected by the user
+@timed('draw_shape')
 def draw_shape(drawing_data):
     if drawing_data['drawing']:
-        drawing_data['temp_img'] = drawing_data['img'].copy() #creates temp image
+        restore_preview(drawing_data) #Only the area of the previous shape is cleaned
         if (drawing_data['start_pos'] == (0, 0)): return
 
         if drawing_data['drawing_mode'] == 'Circle':
@@ -48,19 +295,59 @@ def draw_shape(drawing_data):
             ellipse_axis = (int(abs(drawing_data['previous_x']-drawing_data['start_pos'][0])),int(abs(drawing_data['previous_y']-drawing_data['start_pos'][1])))
             cv2.ellipse(drawing_data['temp_img'], (drawing_data['start_pos'][0], drawing_data['start_pos'][1]), ellipse_axis, 0, 0, 360, drawing_data['color'], drawing_data['thickness'])
 
+        drawing_data['preview_rect'] = clip_rect(shape_rect(drawing_data), drawing_data['img'].shape)
+        drawing_data['version'] += 1
+
+# Returns the image shown in the canvas window
+# With the camera stream the ink is painted over the frame itself, only where there is ink
+def compose_canvas(frame, drawing_data, use_camera_stream):
+    if drawing_data['canvas'] is not None:
+        update_view(drawing_data)
+    #The temp image represents the drawing of a shape that is not yet finished
+    if not use_camera_stream:
+        return drawing_data['temp_img'] if drawing_data['drawing'] else drawing_data['img']
+
+    if drawing_data['ink'] is None:
+        create_ink_layer(drawing_data)
+    ink, t = drawing_data['ink'], INK_TILE
+    for row, tx0, tx1 in ink_runs(ink):
+        y0, y1, x0, x1 = row * t, (row + 1) * t, tx0 * t, tx1 * t
+        _paint_ink(frame, drawing_data['img'], ink['mask'][y0:y1, x0:x1], x0, y0, x1, y1)
+
+    #The shape being drawn only exists in the preview layer, its mask is found every frame
+    rect = drawing_data['preview_rect']
+    if drawing_data['drawing'] and rect is not None:
+        x0, y0, x1, y1 = rect
+        mask = frame_buffers.get('preview_ink', (y1 - y0, x1 - x0), bool)
+        np.any(drawing_data['temp_img'][y0:y1, x0:x1] != ink['background'], axis=2, out=mask)
+        _paint_ink(frame, drawing_data['temp_img'], mask, x0, y0, x1, y1)
+    return frame
+
 # Changes program behavier according to key pressed
 def pressed_key(key, drawing_data, default_img, areas):
+    if key != -1 and drawing_data['log'] is not None:
+        drawing_data['log'].end_action() #A new line after a key is a new stroke
+
     if key == ord('r'):
         print('Setting pencil to red color')
         drawing_data['color'] = (0, 0, 255)
+        log_command(drawing_data, COLOR)
 
     elif key == ord('g'):
         print('Setting pencil to green color')
         drawing_data['color'] = (0, 255, 0)
+        log_command(drawing_data, COLOR)
 
     elif key == ord('b'):
         print('Setting pencil to blue color')
         drawing_data['color'] = (255, 0, 0)
+        log_command(drawing_data, COLOR)
+
+    elif areas is not None and ord('1') <= key < ord('1') + len(areas['palette']) - 1:
+        #Color of a number of the puzzle
+        print(f'Setting pencil to the color of number {chr(key)}')
+        drawing_data['color'] = tuple(int(c) for c in areas['palette'][key - ord('0')])
+        log_command(drawing_data, COLOR)
 
     elif key == ord('+'):
         if drawing_data['thickness'] < 10:
@@ -77,14 +364,17 @@ def pressed_key(key, drawing_data, default_img, areas):
             print('Minimum value is 1')
     
     elif key == ord('s'):
+        if not drawing_data['drawing']: begin_preview(drawing_data)
         drawing_data['drawing_mode'] = 'Square'
         drawing_data['drawing'] = True
 
     elif key == ord('e'):
+        if not drawing_data['drawing']: begin_preview(drawing_data)
         drawing_data['drawing_mode'] = 'Ellipse'
         drawing_data['drawing'] = True
 
     elif key == ord('o'):
+        if not drawing_data['drawing']: begin_preview(drawing_data)
         drawing_data['drawing_mode'] = 'Circle'
         drawing_data['drawing'] = True
 
@@ -92,141 +382,108 @@ def pressed_key(key, drawing_data, default_img, areas):
         print('Changed to line mode')
         drawing_data['drawing_mode'] = 'Line'
 
+    #....Moving around the tiled canvas: [ ] zoom, H J K L pan....
+    elif drawing_data['view'] is not None and key in (ord('['), ord(']')):
+        zoom_viewport(drawing_data['view'], drawing_data['canvas'], 2 if key == ord(']') else 0.5)
+        print(f"Canvas zoom: {1 / drawing_data['view']['scale']:g}x")
+
+    elif drawing_data['view'] is not None and key in (ord('H'), ord('J'), ord('K'), ord('L')):
+        dx, dy = {ord('H'): (-0.25, 0), ord('J'): (0, 0.25), ord('K'): (0, -0.25), ord('L'): (0.25, 0)}[key]
+        pan_viewport(drawing_data['view'], drawing_data['canvas'], dx, dy)
+
     elif key == ord('c'):
         print('Cleared Image')
-        drawing_data['img'] = default_img.copy()
+        replace_drawing_image(drawing_data, default_img.copy())
+        log_command(drawing_data, CLEAR)
+
+    elif key == ord('z'):
+        img = drawing_data['log'].undo(drawing_image(drawing_data)) if drawing_data['log'] is not None else None
+        if img is None:
+            print('Nothing to undo')
+        else:
+            print('Undo')
+            replace_drawing_image(drawing_data, img)
+
+    elif key == ord('y'):
+        img = drawing_data['log'].redo(drawing_image(drawing_data)) if drawing_data['log'] is not None else None
+        if img is None:
+            print('Nothing to redo')
+        else:
+            print('Redo')
+            canvas_replaced(drawing_data)
 
     elif key == ord('w'):
-        print('Saved Image')
         date = datetime.datetime.now().strftime('%a_%b_%d_%H:%M:%S_%Y')
-        cv2.imwrite(f'./drawing_{date}.png', drawing_data['img'])
+        if drawing_data['saver'] is not None:
+            #Encoded and written by the saver thread, the frame loop only copies the drawing
+            log = drawing_data['log'].snapshot() if drawing_data['log'] is not None else None
+            if drawing_data['saver'].save_drawing(f'./drawing_{date}', drawing_image(drawing_data).copy(), log):
+                print('Saving Image')
+            else:
+                print('Still saving, try again')
+        else:
+            print('Saved Image')
+            cv2.imwrite(f'./drawing_{date}.png', drawing_array(drawing_data))
+            if drawing_data['log'] is not None:
+                drawing_data['log'].save(f'./drawing_{date}.npz') #Can be rendered again with stroke_log.py
 
     else: #Used to know when a pressed key was released
         if drawing_data['drawing']:
-            drawing_data['img'] = drawing_data['temp_img'].copy()
+            commit_preview(drawing_data) #Only the shape rectangle is copied
         drawing_data['drawing'] = False
         drawing_data['start_pos'] = (0, 0)
 
 
-def segment_image(drawing_data, h, w):
-    # Create a blank white canvas   
-    num_lines = 3
-    img = np.ones((h, w, 3), np.uint8) * 255
-
-    # Draw 3 vertical polylines
-    for i in range(num_lines):
-        points = []
-
-        # First point: y = 0
-        x1 = (i + 1) * (w // (num_lines + 1))
-        y = 0
-        points.append((x1, y))
-
-        # Second point: limited by 10 pixels on x, y at the bottom
-        x2 = x1 + random.randint(-50, 50)
-        y = h / 2
-        points.append((x2, y))
-
-        # Third point: limited by 10 pixels on x, y at the bottom
-        x = x2 + random.randint(-50, 50)
-        y = h
-        points.append((x, y))
-
-        points = np.array(points, np.int32)
-        points = points.reshape((-1, 1, 2))
-
-        color = (0, 0, 0)
-
-        cv2.polylines(img, [points], isClosed=False, color=color, thickness=2)
-
-    # Draw 3 horizontal polylines
-    for j in range(num_lines):
-        points = []
-
-        # First point: x = 0
-        x = 0
-        y1 = (j + 1) * (h // (num_lines + 1))
-        points.append((x, y1))
-
-        # Second point: limited by 10 pixels on y, x at the right end
-        x = w / 2
-        y2 = y1 + random.randint(-50, 50)
-        points.append((x, y2))
-
-        # Third point: limited by 10 pixels on y, x at the right end
-        x = w
-        y = y2 + random.randint(-50, 50)
-        points.append((x, y))
-
-        points = np.array(points, np.int32)
-        points = points.reshape((-1, 1, 2))
-
-        color = (0, 0, 0)
-
-        cv2.polylines(img, [points], isClosed=False, color=color, thickness=2)
-
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    # Apply thresholding to separate regions
-    ret, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)
-
-    # Find contours of connected components
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    areas=[]
-    # Assign random numbers to sections and label them at the center
-    for i, contour in enumerate(contours):
-        section_number = random.randint(1, 3)
-        if section_number == 1:
-            col=(0,0,255)
-        elif section_number == 2:
-            col=(0,255,0)
-        else: 
-            col=(255,0,0)
-        M = cv2.moments(contour)
-        if M["m00"] != 0:
-            cX = int(M["m10"] / M["m00"])
-            cY = int(M["m01"] / M["m00"])
-            cv2.circle(img, (cX,cY), 15, col, -1)
-            cv2.putText(img, str(section_number), (cX, cY), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
-        areas.append((contour,section_number))
-
-    # Draw contours on the image for visualization
-    cv2.drawContours(img, contours, -1, (0, 0, 0), 2)
+# Puts a paint-by-number puzzle (see paint_by_number.py) in the canvas and returns the scoring data
+def segment_image(drawing_data, h, w, seed, cache_dir=None, **params):
+    puzzle = create_puzzle(w, h, seed, cache_dir, **params)
+    img = puzzle['img']
 
     # Display the image
     drawing_data['img'] = img.copy()
+    drawing_data['dirty'] = [] #From now on the changed regions of the canvas are saved
+
+    # Scoring data, the color sums of every region are updated only where the canvas changes
+    num_regions = puzzle['num_regions'] + 1
+    flat_labels = puzzle['labels'].ravel()
+    areas = {'labels': puzzle['labels'],
+             'numbers': puzzle['numbers'],
+             'palette': puzzle['palette'],
+             'num_regions': puzzle['num_regions'],
+             'counts': np.maximum(puzzle['counts'], 1),
+             'sums': np.stack([np.bincount(flat_labels, weights=img[:, :, c].ravel(), minlength=num_regions) for c in range(3)], axis=1),
+             'scored_img': img.copy(), #Canvas as it was the last time the score was updated
+             'score': None}
     return areas
 
+@timed('calculate_score')
 def calculate_score(drawing_data, dificulty, areas):
-    color_map = {
-    1: (0, 0, 255),  
-    2: (0, 255, 0), 
-    3: (255, 0, 0)
-}
-
-    # Initialize user's score
-    user_score = 0
-
-    # Iterate through the contours you have
-    for contour, area_number in areas:
-        # Calculate the average color within the contour
-        x, y, w, h = cv2.boundingRect(contour)
-        roi = drawing_data['img'][y:y+h, x:x+w]
-        average_color = np.mean(roi, axis=(0, 1))
-
-        # Get the expected color from the color map
-        expected_color = color_map.get(area_number, (0, 0, 0))
-
-        # Define a color similarity threshold
-        color_similarity_threshold = int(200/dificulty)  # Tweak as needed
-
-        # Compare the color of the area with the expected color
-        color_diff = np.linalg.norm(average_color - expected_color)
-        if color_diff < color_similarity_threshold:
-            user_score += 1  # Increment the score for a correct color
-
-    # Display the user's score on the AR interface
-    drawing_data['score_board'] = np.ones((100, 300, 3), dtype=np.uint8) #clear the text
-    cv2.putText(drawing_data['score_board'], f"Score: {user_score} / 16", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+    # Update the color sums with the pixels that have changed since the last time
+    img, scored_img, sums = drawing_data['img'], areas['scored_img'], areas['sums']
+    for x0, y0, x1, y1 in drawing_data['dirty']:
+        labels = areas['labels'][y0:y1, x0:x1].ravel()
+        difference = img[y0:y1, x0:x1].astype(np.int32) - scored_img[y0:y1, x0:x1]
+        for c in range(3):
+            sums[:, c] += np.bincount(labels, weights=difference[:, :, c].ravel(), minlength=len(sums))
+        scored_img[y0:y1, x0:x1] = img[y0:y1, x0:x1]
+    drawing_data['dirty'].clear()
+
+    # Calculate the average color within every region
+    average_color = sums / areas['counts'][:, None]
+
+    # Get the expected color from the palette of the puzzle
+    expected_color = areas['palette'][areas['numbers']]
+
+    # Define a color similarity threshold
+    color_similarity_threshold = int(200/dificulty)  # Tweak as needed
+
+    # Compare the color of the areas with the expected color
+    color_diff = np.linalg.norm(average_color - expected_color, axis=1)
+    user_score = int(np.count_nonzero(color_diff[1:] < color_similarity_threshold))
+
+    # Display the user's score on the AR interface, only when it has changed
+    if user_score == areas['score']:
+        return
+    areas['score'] = user_score
+    drawing_data['score_board'][:] = 1 #clear the text
+    cv2.putText(drawing_data['score_board'], f"Score: {user_score} / {areas['num_regions']}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
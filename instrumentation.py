@@ -0,0 +1,147 @@
+import functools
+import json
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+#Upper limits (ms) of the histogram bins exported for every stage, the last bin has everything above
+HISTOGRAM_BINS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+# Used instead of a real timer when the metrics are disabled, so it costs almost nothing
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+        return False
+
+# Times the stages of the frame loop, shows the FPS and exports rolling histograms
+class Metrics:
+    def __init__(self):
+        self.configure(enabled=False)
+
+    def configure(self, enabled=True, export_path=None, window=120, export_interval=1.0, slow_frame_ms=100):
+        self.enabled = enabled
+        self.window = window
+        self.export_interval = export_interval
+        self.slow_frame_ms = slow_frame_ms
+        self.samples = {}       #Stage name -> total duration in the last frames (seconds)
+        self.current = {}       #Stage name -> duration in the frame being processed
+        self.lap_start = time.perf_counter()
+        self.frame_times = deque(maxlen=window)
+        self.frame_index = 0
+        self.last_frame_end = None
+        self.last_export = time.perf_counter()
+        self.export_file = open(export_path, 'w') if enabled and export_path is not None else None
+
+    # Context manager that times a stage: with metrics.stage('detection'): ...
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    # Times what has happened since the previous lap, so the frame loop doesn't need to be indented
+    def lap(self, name):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.add(name, now - self.lap_start)
+        self.lap_start = now
+
+    def add(self, name, duration):
+        self.current[name] = self.current.get(name, 0.0) + duration
+
+    # Must be called at the end of every frame
+    def frame_done(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last_frame_end is not None:
+            frame_time = now - self.last_frame_end
+            self.frame_times.append(frame_time)
+            #A slow frame is exported right away with the time of every stage, to know who is guilty
+            if self.export_file is not None and frame_time * 1000 > self.slow_frame_ms:
+                self._write({'type': 'slow_frame', 'frame': self.frame_index, 'frame_ms': frame_time * 1000,
+                             'stages_ms': {k: v * 1000 for k, v in self.current.items()}})
+        for name, duration in self.current.items():
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(duration)
+        self.last_frame_end = now
+        self.lap_start = now
+        self.frame_index += 1
+        self.current = {}
+
+        if self.export_file is not None and now - self.last_export >= self.export_interval:
+            self.last_export = now
+            self._write(self.summary())
+
+    def fps(self):
+        if not self.frame_times:
+            return 0.0
+        return len(self.frame_times) / sum(self.frame_times)
+
+    def summary(self):
+        stages = {}
+        for name, samples in self.samples.items():
+            values = np.array(samples) * 1000
+            stages[name] = {'count': len(values),
+                            'p50_ms': float(np.percentile(values, 50)),
+                            'p99_ms': float(np.percentile(values, 99)),
+                            'max_ms': float(values.max()),
+                            'histogram': np.bincount(np.searchsorted(HISTOGRAM_BINS_MS, values), minlength=len(HISTOGRAM_BINS_MS) + 1).tolist()}
+        return {'type': 'summary', 'frame': self.frame_index, 'fps': self.fps(), 'bins_ms': HISTOGRAM_BINS_MS, 'stages': stages}
+
+    def _write(self, record):
+        record['t'] = time.time()
+        self.export_file.write(json.dumps(record) + '\n')
+
+    # Writes the FPS and the median time of every stage on the image
+    def overlay(self, img):
+        if not self.enabled:
+            return img
+        lines = [f'FPS: {self.fps():.1f}']
+        for name, samples in self.samples.items():
+            lines.append(f'{name}: {np.median(samples) * 1000:.1f} ms')
+        for i, text in enumerate(lines):
+            cv2.putText(img, text, (10, 25 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 4)
+            cv2.putText(img, text, (10, 25 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 1)
+        return img
+
+    def close(self):
+        if self.export_file is not None:
+            self._write(self.summary())
+            self.export_file.close()
+            self.export_file = None
+
+#Shared by ar_paint and functions
+metrics = Metrics()
+
+# Decorator that times every call of a function as a stage with the given name
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
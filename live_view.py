@@ -0,0 +1,212 @@
+import asyncio
+import socket
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Shows the canvas to other screens through HTTP: http://HOST:PORT/ is a page with the live canvas (MJPEG)
+# Every frame is encoded once, on the encoder thread, whatever the number of viewers
+# The frame loop only copies the frame, and not even that when nobody is watching
+# /snapshot.jpg is a single JPEG: it waits for the next frame, so it is encoded even when nobody watches the stream
+# Every viewer gets the newest JPEG when it is ready for one, a slow viewer skips the frames it couldn't take
+
+BOUNDARY = b'frame'
+PAGE = b'<html><head><title>AR Paint</title></head><body style="margin:0;background:#222">' \
+       b'<img src="/stream" style="display:block;margin:auto;max-width:100%;max-height:100vh"></body></html>'
+
+# 'PORT' listens only on this computer, 'HOST:PORT' on that address (0.0.0.0 for the whole LAN)
+def parse_address(text):
+    host, _, port = str(text).rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+class LiveViewServer:
+    def __init__(self, host='127.0.0.1', port=8080, quality=80):
+        self.host, self.port = host, port
+        self.quality = quality
+
+        #....Frame given by the frame loop, waiting for the encoder....
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.buffers = []       #Two frame copies: one being encoded, one being filled
+        self.pending = None     #Index of the buffer with the newest frame not encoded yet
+        self.encoding = None    #Index of the buffer being encoded
+        self.running = False
+
+        #....Newest JPEG, only used by the server thread....
+        self.jpeg = None
+        self.sequence = 0
+        self.waiting = set()    #Events of the viewers waiting for the next JPEG
+        self.viewers = 0
+
+        #....Statistics....
+        self.published = 0
+        self.encoded = 0
+        self.sent = 0
+        self.skipped = 0        #Frames viewers didn't get because they were still sending an older one
+        self.encode_time = 0.0
+
+    def start(self):
+        started = threading.Event()
+        self.running = True
+        self.server_thread = threading.Thread(target=self._serve, args=(started,), name='LiveViewServer', daemon=True)
+        self.server_thread.start()
+        started.wait()
+        if self.loop is None:
+            self.running = False
+            return False
+        self.encoder_thread = threading.Thread(target=self._encode_loop, name='LiveViewEncoder', daemon=True)
+        self.encoder_thread.start()
+        print(f'Live view on http://{self.host}:{self.port}/')
+        return True
+
+    # Gives a new frame to the viewers, called by the frame loop after the canvas is composed
+    def publish(self, frame):
+        if self.viewers == 0:
+            return #Nothing is copied or encoded when nobody is watching
+        with self.lock:
+            if not self.buffers or self.buffers[0].shape != frame.shape:
+                self.buffers = [np.empty_like(frame), np.empty_like(frame)]
+                self.encoding = None
+            #The buffer that isn't being encoded, the frame there is replaced if it wasn't encoded yet
+            index = 1 if self.encoding == 0 else 0
+            np.copyto(self.buffers[index], frame)
+            self.pending = index
+            self.published += 1
+            self.new_frame.notify()
+
+    def _encode_loop(self):
+        while True:
+            with self.lock:
+                while self.running and self.pending is None:
+                    self.new_frame.wait()
+                if not self.running:
+                    return
+                self.encoding, self.pending = self.pending, None
+                frame = self.buffers[self.encoding]
+            start = time.perf_counter()
+            ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality]) #Runs without the GIL
+            self.encode_time += time.perf_counter() - start
+            with self.lock:
+                self.encoding = None
+            if ok:
+                self.encoded += 1
+                self.loop.call_soon_threadsafe(self._jpeg_ready, jpeg.tobytes())
+
+    # Runs in the server thread
+    def _jpeg_ready(self, jpeg):
+        self.jpeg = jpeg
+        self.sequence += 1
+        for event in self.waiting:
+            event.set()
+
+    # Runs in the server thread, the next JPEG (or the last one if no frame comes in time)
+    async def _next_jpeg(self, timeout=2.0):
+        event = asyncio.Event()
+        self.waiting.add(event)
+        self.viewers += 1 #publish() only copies the frame when someone waits for it
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass #The frame loop is not publishing (e.g. paused)
+        finally:
+            self.waiting.discard(event)
+            self.viewers -= 1
+        return self.jpeg
+
+    def _serve(self, started):
+        self.loop = None
+        loop = asyncio.new_event_loop()
+        try:
+            server = loop.run_until_complete(asyncio.start_server(self._client, self.host, self.port))
+        except OSError as error:
+            print(f'Could not start the live view on {self.host}:{self.port}: {error}')
+            loop.close()
+            started.set()
+            return
+        self.loop, self.server = loop, server
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    # Runs in the server thread, stops listening and ends the viewer connections
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            path = request.split(b' ')[1].split(b'?')[0] if request.count(b' ') >= 2 else b'/'
+            jpeg = await self._next_jpeg() if path == b'/snapshot.jpg' else None
+            if path == b'/stream':
+                await self._stream(writer)
+            elif jpeg is not None:
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\nCache-Control: no-cache\r\n\r\n' % len(jpeg))
+                writer.write(jpeg)
+            elif path == b'/':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n' % len(PAGE) + PAGE)
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass #Closed by _shutdown, the connection just ends
+        finally:
+            writer.close()
+
+    async def _stream(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nCache-Control: no-cache\r\nConnection: close\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY + b'\r\n\r\n')
+        writer.transport.set_write_buffer_limits(high=0) #drain() waits for the whole JPEG, so nothing old piles up
+        sock = writer.get_extra_info('socket')
+        event = asyncio.Event()
+        self.waiting.add(event)
+        self.viewers += 1
+        sequence = 0
+        try:
+            while self.running:
+                if self.sequence == sequence:
+                    await event.wait()
+                    event.clear()
+                    continue
+                #The newest JPEG, the ones that came while the last one was being sent are skipped
+                if sequence > 0:
+                    self.skipped += self.sequence - sequence - 1
+                sequence, jpeg = self.sequence, self.jpeg
+                #The system buffer holds about one JPEG, else a slow viewer would get frames from seconds ago
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, max(16384, len(jpeg)))
+                writer.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg))
+                writer.write(jpeg)
+                writer.write(b'\r\n')
+                await asyncio.wait_for(writer.drain(), 10) #Only this viewer waits for its network, a stuck one is closed
+                self.sent += 1
+        finally:
+            self.waiting.discard(event)
+            self.viewers -= 1
+
+    def stats(self):
+        return {'published': self.published, 'encoded': self.encoded, 'sent': self.sent, 'skipped': self.skipped,
+                'encode_ms_mean': self.encode_time / max(1, self.encoded) * 1000}
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.new_frame.notify()
+        if self.loop is None:
+            return
+        self.encoder_thread.join()
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=2.0)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server_thread.join()
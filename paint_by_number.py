@@ -0,0 +1,130 @@
+import glob
+import os
+
+import cv2
+import numpy as np
+
+# Paint-by-number puzzles: a grid of wavy lines cuts the canvas in cells, neighbouring cells can be joined into bigger regions
+# Every region gets a number, the color it has to be painted with is that entry of the palette
+# The same seed, size and parameters always give the same puzzle, so it is generated once and then read from the cache
+
+PUZZLE_VERSION = 2 #Changes whenever the generator draws something different, old cache files are then ignored
+
+#....Palettes (BGR), number n is palette[n - 1]....
+PALETTES = {'rgb': [(0, 0, 255), (0, 255, 0), (255, 0, 0)],
+            'cmy': [(255, 255, 0), (255, 0, 255), (0, 255, 255)],
+            'rgbcmy': [(0, 0, 255), (0, 255, 0), (255, 0, 0), (255, 255, 0), (255, 0, 255), (0, 255, 255)]}
+
+# Position of every line at every pixel of the other axis: three points (start, middle, end) moved at random
+# The moves are small enough that two neighbouring lines never cross
+def _wavy_lines(rng, grid, length, across, jitter):
+    spacing = across // (grid + 1)
+    jitter = max(0, min(jitter, spacing // 5))
+    starts = (np.arange(grid) + 1) * spacing
+    middles = starts + rng.integers(-jitter, jitter + 1, grid)
+    ends = middles + rng.integers(-jitter, jitter + 1, grid)
+    positions = np.arange(length)
+    return np.stack([np.interp(positions, (0, length / 2, length), (s, m, e)) for s, m, e in zip(starts, middles, ends)])
+
+# Joins random neighbouring cells until only `regions` are left, returns the region (0..regions-1) of every cell
+def _merge_cells(rng, grid, regions):
+    side = grid + 1
+    parent = np.arange(side * side)
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    edges = [(r * side + c, r * side + c + 1) for r in range(side) for c in range(side - 1)]
+    edges += [(r * side + c, (r + 1) * side + c) for r in range(side - 1) for c in range(side)]
+    count = side * side
+    for i in rng.permutation(len(edges)):
+        if count <= regions:
+            break
+        a, b = root(edges[i][0]), root(edges[i][1])
+        if a != b:
+            parent[b] = a
+            count -= 1
+    roots = np.array([root(i) for i in range(side * side)])
+    return np.unique(roots, return_inverse=True)[1]
+
+# Builds a puzzle of w x h pixels
+# grid: wavy lines in each direction, (grid + 1)^2 cells
+# regions: how many regions the cells are joined into, None keeps every cell
+def generate_puzzle(w, h, seed, grid=3, regions=None, palette='rgb', jitter=50):
+    rng = np.random.default_rng(seed)
+    colors = PALETTES[palette]
+
+    #....Cell of every pixel, by counting the lines at its left and above it....
+    vertical = _wavy_lines(rng, grid, h, w, jitter)    #x of every vertical line at every row
+    horizontal = _wavy_lines(rng, grid, w, h, jitter)  #y of every horizontal line at every column
+    cells = np.zeros((h, w), np.int32)
+    xs, ys = np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32)[:, None]
+    for line in vertical.astype(np.float32):
+        cells += xs >= line[:, None]
+    for line in horizontal.astype(np.float32):
+        cells += (ys >= line) * np.int32(grid + 1)
+
+    num_cells = (grid + 1) ** 2
+    regions = num_cells if regions is None else min(max(1, regions), num_cells)
+    cell_region = _merge_cells(rng, grid, regions) + 1
+    labels = cell_region[cells].astype(np.uint8 if regions < 256 else np.uint16) #Region 0 is the borders
+
+    #....Borders, where the region changes, belong to no region (label 0)....
+    border = np.zeros((h, w), np.uint8)
+    border[:, :-1] |= labels[:, :-1] != labels[:, 1:]
+    border[:-1] |= labels[:-1] != labels[1:]
+    border = cv2.dilate(border, np.ones((3, 3), np.uint8)).astype(bool)
+    labels[border] = 0
+
+    img = np.full((h, w, 3), 255, np.uint8)
+    img[border] = 0
+
+    #....Numbers, written at the center of the biggest cell of every region....
+    numbers = np.concatenate(([0], rng.integers(1, len(colors) + 1, regions)))
+    #Every 4th pixel is enough to find the centers
+    step = 4
+    flat_cells = np.where(border, num_cells, cells)[::step, ::step].ravel()
+    ys, xs = np.indices((-(-h // step), -(-w // step))) * step
+    cell_counts = np.bincount(flat_cells, minlength=num_cells + 1)[:num_cells]
+    cell_x = np.bincount(flat_cells, weights=xs.ravel(), minlength=num_cells + 1)[:num_cells] / np.maximum(cell_counts, 1)
+    cell_y = np.bincount(flat_cells, weights=ys.ravel(), minlength=num_cells + 1)[:num_cells] / np.maximum(cell_counts, 1)
+    centers = np.zeros((regions + 1, 2), np.int32)
+    order = np.argsort(cell_counts, kind='stable') #The bigger cells are written last and win
+    centers[cell_region[order]] = np.stack([cell_x[order], cell_y[order]], axis=1).astype(np.int32)
+    for number, (cX, cY) in zip(numbers[1:], centers[1:]):
+        cv2.circle(img, (int(cX), int(cY)), 15, colors[number - 1], -1)
+        cv2.putText(img, str(number), (int(cX), int(cY)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+
+    return {'img': img,
+            'labels': labels,
+            'numbers': numbers,
+            'centers': centers,
+            'counts': np.bincount(labels.ravel(), minlength=regions + 1),
+            'palette': np.array([(0, 0, 0)] + colors), #Row 0 is the color of the borders
+            'num_regions': regions}
+
+def puzzle_cache_path(cache_dir, w, h, seed, grid=3, regions=None, palette='rgb', jitter=50):
+    return os.path.join(cache_dir, f'puzzle_v{PUZZLE_VERSION}_{w}x{h}_seed{seed}_g{grid}_r{regions}_{palette}_j{jitter}.npz')
+
+# Same as generate_puzzle, but reads the puzzle from cache_dir when it was already generated
+# Only the max_cached most recently generated puzzles are kept
+def create_puzzle(w, h, seed, cache_dir=None, max_cached=32, **params):
+    path = puzzle_cache_path(cache_dir, w, h, seed, **params) if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        with np.load(path) as data:
+            puzzle = {k: data[k] for k in data.files}
+        puzzle['num_regions'] = int(puzzle['num_regions'])
+        return puzzle
+
+    puzzle = generate_puzzle(w, h, seed, **params)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary = path[:-len('.npz')] + '.tmp.npz'
+        np.savez_compressed(temporary, **puzzle) #Mostly flat colors, a few tens of kB that still read in milliseconds
+        os.replace(temporary, path)
+        cached = sorted(glob.glob(os.path.join(cache_dir, 'puzzle_*.npz')), key=os.path.getmtime)
+        for old in cached[:-max_cached]:
+            os.remove(old)
+    return puzzle
@@ -0,0 +1,77 @@
+import time
+
+import cv2
+
+# Decides how long to wait for a key at the end of every frame
+# 'fps' mode keeps a steady frame rate, 'latency' mode only polls the keys and goes straight to the next frame
+# In 'latency' mode the budget is the time between camera frames, a frame slower than that makes the next one late
+class FrameScheduler:
+    def __init__(self, target='30', headless=False, max_score_interval=8):
+        if str(target) == 'latency':
+            self.mode = 'latency'
+            self.budget = None      #Known after a few frames
+        else:
+            self.mode = 'fps'
+            self.budget = 1.0 / float(target) #Seconds per frame
+        self.headless = headless
+        self.last_capture = None    #(capture time, frames captured) of the previous frame
+
+        self.frame_start = time.perf_counter()
+        self.load = 0.0             #Processing time / budget, smoothed
+        self.frames = 0
+        self.misses = 0             #Frames that took longer than the budget
+        self.max_score_interval = max_score_interval
+        self.score_interval = 1     #The score is updated once every N frames when the machine is slow
+        self.skipped_scores = 0
+
+    def start_frame(self):
+        self.frame_start = time.perf_counter()
+
+    # Measures the camera frame interval from the capture times, captured counts every frame the camera gave
+    # (the dropped ones too), so a slow frame loop doesn't make the camera look slower
+    def frame_captured(self, timestamp, captured):
+        if timestamp is None:
+            return
+        if self.mode == 'latency' and self.last_capture is not None and captured > self.last_capture[1]:
+            interval = (timestamp - self.last_capture[0]) / (captured - self.last_capture[1])
+            self.budget = interval if self.budget is None else 0.9 * self.budget + 0.1 * interval
+        self.last_capture = (timestamp, captured)
+        if self.mode == 'latency':
+            self.frame_start = time.perf_counter() #The wait for the camera is not part of the work of the frame
+
+    # Waits the time left in the frame budget (at least 1 ms so the windows are updated) and returns the key
+    def wait_key(self):
+        elapsed = time.perf_counter() - self.frame_start
+        self.frames += 1
+
+        if self.budget is not None:
+            load = elapsed / self.budget
+            if load > 1:
+                self.misses += 1
+            self.load = 0.9 * self.load + 0.1 * load
+
+            #....Graceful degradation, the score is the first thing to go....
+            if self.load > 1 and self.score_interval < self.max_score_interval:
+                self.score_interval *= 2
+            elif self.load < 0.7 and self.score_interval > 1:
+                self.score_interval //= 2
+
+        #Latency mode never waits for the budget, only for the keys
+        wait_ms = max(1, int((self.budget - elapsed) * 1000)) if self.mode == 'fps' else 1
+
+        if self.headless:
+            if wait_ms > 1:
+                time.sleep(wait_ms / 1000)
+            return -1
+        return cv2.waitKey(wait_ms)
+
+    # True if the score should be updated in this frame
+    def should_score(self):
+        if self.frames % self.score_interval == 0:
+            return True
+        self.skipped_scores += 1
+        return False
+
+    def stats(self):
+        return {'mode': self.mode, 'frames': self.frames, 'deadline_misses': self.misses,
+                'skipped_scores': self.skipped_scores, 'load': self.load}
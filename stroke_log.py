@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+
+import cv2
+import numpy as np
+
+#....Commands....
+LINE = 1
+CIRCLE = 2
+SQUARE = 3
+ELLIPSE = 4
+COLOR = 5
+CLEAR = 6
+
+DRAWING_OPS = (LINE, CIRCLE, SQUARE, ELLIPSE, CLEAR)
+SHAPE_OPS = {'Circle': CIRCLE, 'Square': SQUARE, 'Ellipse': ELLIPSE}
+
+# Every command is one row of a numpy array, 25 bytes each
+COMMAND_DTYPE = np.dtype([('op', np.uint8), ('thickness', np.uint8),
+                          ('b', np.uint8), ('g', np.uint8), ('r', np.uint8),
+                          ('action', np.int32),
+                          ('x0', np.int32), ('y0', np.int32), ('x1', np.int32), ('y1', np.int32)])
+
+def make_command(op, start=(0, 0), end=(0, 0), color=(0, 0, 0), thickness=1, action=0):
+    return np.array((op, thickness, color[0], color[1], color[2], action, start[0], start[1], end[0], end[1]), COMMAND_DTYPE)
+
+# Rectangle (x0, y0, x1, y1) that contains everything a drawing command changes, None for the whole image
+def command_rect(command):
+    op, t = command['op'], int(command['thickness'])
+    x0, y0, x1, y1 = (int(command[k]) for k in ('x0', 'y0', 'x1', 'y1'))
+    if op == CIRCLE:
+        r = int(np.sqrt((x0 - x1) ** 2 + (y0 - y1) ** 2))
+        return (x0 - r - t, y0 - r - t, x0 + r + t + 1, y0 + r + t + 1)
+    elif op == ELLIPSE:
+        ax, ay = abs(x1 - x0), abs(y1 - y0)
+        return (x0 - ax - t, y0 - ay - t, x0 + ax + t + 1, y0 + ay + t + 1)
+    elif op in (LINE, SQUARE):
+        return (min(x0, x1) - t, min(y0, y1) - t, max(x0, x1) + t + 1, max(y0, y1) + t + 1)
+    return None
+
+# Draws one command in the image, the coordinates can be scaled to render at another resolution
+# offset is the position of the image in the drawing, to draw in a piece of it (e.g. a tile)
+def render_command(img, command, base, scale=1.0, offset=(0, 0)):
+    if not isinstance(img, np.ndarray):
+        return img.render_command(command, base) #Tiled canvases draw it in every tile it touches
+    op = command['op']
+    color = (int(command['b']), int(command['g']), int(command['r']))
+    thickness = max(1, int(round(int(command['thickness']) * scale)))
+    x0, y0 = int(round(command['x0'] * scale)) - offset[0], int(round(command['y0'] * scale)) - offset[1]
+    x1, y1 = int(round(command['x1'] * scale)) - offset[0], int(round(command['y1'] * scale)) - offset[1]
+
+    if op == LINE:
+        cv2.line(img, (x0, y0), (x1, y1), color, thickness)
+    elif op == CIRCLE:
+        #The radius is computed like in draw_shape, before scaling
+        radius = int(np.sqrt((int(command['x0']) - int(command['x1'])) ** 2 + (int(command['y0']) - int(command['y1'])) ** 2))
+        cv2.circle(img, (x0, y0), int(round(radius * scale)), color, thickness)
+    elif op == SQUARE:
+        cv2.rectangle(img, (x0, y0), (x1, y1), color, thickness)
+    elif op == ELLIPSE:
+        cv2.ellipse(img, (x0, y0), (abs(x1 - x0), abs(y1 - y0)), 0, 0, 360, color, thickness)
+    elif op == CLEAR:
+        img[:] = base
+
+# Record of everything drawn in the canvas, with undo and redo
+# The canvas can be an image or a TiledCanvas, copies of a TiledCanvas are cheap (copy-on-write)
+class StrokeLog:
+    def __init__(self, base, checkpoint_interval=256, max_checkpoints=8, capacity=4096):
+        self.commands = np.zeros(capacity, COMMAND_DTYPE)
+        self.length = 0         #Commands that are part of the drawing
+        self.end = 0            #Commands that can still be redone
+        self.action = 0         #Id of the current action (a stroke, a shape, a clear...)
+        self.open_actions = {}  #Pen -> id of the stroke it is drawing, several pens can draw at the same time
+        self.base = base.copy()
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.checkpoints = {0: self.base} #Image after the first N commands
+
+    # Stops grouping the next lines of pen with its previous ones (e.g. the pen was lifted), None ends every stroke
+    def end_action(self, pen=None):
+        if pen is None:
+            self.open_actions.clear()
+        else:
+            self.open_actions.pop(pen, None)
+
+    # Saves a command, img must already have it drawn
+    # The lines of a pen are one action until end_action, the lines of other pens in between are not part of it
+    def record(self, img, op, start=(0, 0), end=(0, 0), color=(0, 0, 0), thickness=1, pen=''):
+        #Anything new removes the commands that could be redone
+        if self.end > self.length:
+            self.end = self.length
+            self.checkpoints = {k: v for k, v in self.checkpoints.items() if k <= self.length}
+
+        if op == LINE and pen in self.open_actions:
+            action = self.open_actions[pen]
+        else:
+            self.action += 1
+            action = self.action
+            if op == LINE:
+                self.open_actions[pen] = action
+            else:
+                self.open_actions.clear() #A shape or a clear ends every stroke
+
+        if self.length == len(self.commands):
+            commands = np.zeros(2 * len(self.commands), COMMAND_DTYPE)
+            commands[:self.length] = self.commands[:self.length]
+            self.commands = commands
+
+        self.commands[self.length] = make_command(op, start, end, color, thickness, action)
+        self.length += 1
+        self.end = self.length
+
+        #....Periodic checkpoint so undo only has to replay a few commands....
+        if op in DRAWING_OPS and self.length - max(self.checkpoints) >= self.checkpoint_interval:
+            self.checkpoints[self.length] = img.copy()
+            if len(self.checkpoints) > self.max_checkpoints:
+                del self.checkpoints[min(k for k in self.checkpoints if k > 0)] #The base is always kept
+
+    # Index of the first command of the last action that changed the drawing
+    # Lines of other pens drawn during that action are moved before it, so the action is the end of the log
+    def _previous_action_start(self):
+        i = self.length
+        while i > 0 and self.commands['op'][i - 1] not in DRAWING_OPS:
+            i -= 1
+        if i == 0:
+            return None
+        action = self.commands['action'][i - 1]
+        first = int(np.flatnonzero(self.commands['action'][:i] == action)[0])
+        commands = self.commands[first:self.length]
+        last = commands['action'] == action
+        last[i - first:] = True
+        if not last.all():
+            self.commands[first:self.length] = np.concatenate((commands[~last], commands[last]))
+            self.checkpoints = {k: v for k, v in self.checkpoints.items() if k <= first}
+        return self.length - int(np.count_nonzero(last))
+
+    # Returns the image without the last action, built from the nearest checkpoint
+    def undo(self, img):
+        target = self._previous_action_start()
+        if target is None:
+            return None
+
+        checkpoint = max(k for k in self.checkpoints if k <= target)
+        img = self.checkpoints[checkpoint].copy()
+        for command in self.commands[checkpoint:target]:
+            render_command(img, command, self.base)
+        self.length = target
+        self.open_actions.clear()
+        return img
+
+    # Draws again the last action that was undone, img is changed in place
+    def redo(self, img):
+        if self.length == self.end:
+            return None
+
+        i = self.length
+        while i < self.end and self.commands['op'][i] not in DRAWING_OPS:
+            i += 1
+        if i < self.end:
+            action = self.commands['action'][i]
+            while i < self.end and self.commands['action'][i] == action:
+                i += 1
+
+        for command in self.commands[self.length:i]:
+            render_command(img, command, self.base)
+        self.length = i
+        self.open_actions.clear()
+        return img
+
+    # Commands of the drawing and the base, can be saved later (e.g. by another thread) with save_log
+    def snapshot(self):
+        return self.commands[:self.length].copy(), self.base
+
+    def save(self, path):
+        save_log(path, *self.snapshot())
+
+    # Continues a saved drawing: the commands were already drawn in img, they can be undone
+    def restore(self, commands, img):
+        self.commands = np.zeros(max(len(self.commands), 2 * len(commands)), COMMAND_DTYPE)
+        self.commands[:len(commands)] = commands
+        self.length = self.end = len(commands)
+        self.action = int(commands['action'].max()) if len(commands) else 0
+        self.open_actions = {}
+        self.checkpoints = {0: self.base}
+        if self.length > 0:
+            self.checkpoints[self.length] = img.copy()
+
+def save_log(path, commands, base):
+    base = base if isinstance(base, np.ndarray) else base.to_image()
+    np.savez_compressed(path, commands=commands, base=base)
+
+# Loads a saved log (commands, base image)
+def load_log(path):
+    data = np.load(path)
+    return data['commands'], data['base']
+
+# Draws a saved log without any window, at any resolution
+def render_log(commands, base, scale=1.0):
+    h, w = base.shape[:2]
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    base = cv2.resize(base, size, interpolation=cv2.INTER_NEAREST) if scale != 1.0 else base.copy()
+    img = base.copy()
+    for command in commands:
+        render_command(img, command, base, scale)
+    return img
+
+def main():
+    parser = argparse.ArgumentParser(description='Renders a saved AR Paint drawing log')
+    parser.add_argument('log', type=str, help='Path to the .npz log saved with the w key')
+    parser.add_argument('output', type=str, help='Path of the image to write')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='Resolution multiplier')
+    args = vars(parser.parse_args())
+
+    commands, base = load_log(args['log'])
+    cv2.imwrite(args['output'], render_log(commands, base, args['scale']))
+    print(f"Rendered {len(commands)} commands to {args['output']}")
+
+if __name__ == '__main__':
+    main()
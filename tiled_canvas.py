@@ -0,0 +1,235 @@
+import itertools
+import zlib
+
+import cv2
+import numpy as np
+
+from stroke_log import CLEAR, render_command, command_rect
+
+TILE_SIZE = 256
+CANVAS_SIZES = {'1080p': (1920, 1080), '4k': (3840, 2160), '8k': (7680, 4320)}
+OUTSIDE_COLOR = (64, 64, 64) #Part of the window that is outside the canvas
+_versions = itertools.count(1) #Shared by all the canvases, a copy that changes a tile never reuses a number
+
+# Canvas much bigger than the camera, made of square tiles
+# Only the tiles that have been drawn on exist, the rest are the background and cost no memory
+# Tiles that haven't been drawn on for a while are compressed, they are uncompressed again when drawn on
+# copy() is copy-on-write: both canvases share their tiles until one of them draws on a tile
+class TiledCanvas:
+    def __init__(self, width, height, background=(255, 255, 255), tile_size=TILE_SIZE):
+        self.width, self.height = width, height
+        self.shape = (height, width, 3)
+        self.background = tuple(background)
+        self.tile_size = tile_size
+        self.blank = np.full((tile_size, tile_size, 3), background, np.uint8)
+        self.blank.flags.writeable = False
+        self.tiles = {}         #(tx, ty) -> array, or zlib bytes when it is compressed
+        self.owned = set()      #Tiles that can be changed in place, the others may be shared with a copy
+        self.last_used = {}     #Uncompressed tile -> clock when it was last drawn on
+        self.versions = {}      #Tile -> number that changes every time it is drawn on (not when it is compressed)
+        self.clock = 0
+        self.dirty = set()      #Tiles changed since the view was rendered
+
+    def copy(self):
+        canvas = TiledCanvas(self.width, self.height, self.background, self.tile_size)
+        canvas.tiles = dict(self.tiles)
+        canvas.last_used = dict(self.last_used)
+        canvas.versions = dict(self.versions)
+        canvas.clock = self.clock
+        self.owned.clear() #The tiles are shared now, the next change copies them
+        return canvas
+
+    def tile_range(self, x0, y0, x1, y1):
+        t = self.tile_size
+        tx0, ty0 = max(0, x0 // t), max(0, y0 // t)
+        tx1, ty1 = min(-(-self.width // t), -(-x1 // t)), min(-(-self.height // t), -(-y1 // t))
+        return [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+    # The pixels of a tile, must not be changed
+    def read_tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            return self.blank
+        if isinstance(tile, bytes):
+            return np.frombuffer(zlib.decompress(tile), np.uint8).reshape(self.blank.shape)
+        return tile
+
+    def _writable_tile(self, key):
+        tile = self.tiles.get(key)
+        if not isinstance(tile, np.ndarray) or key not in self.owned:
+            tile = self.read_tile(key).copy()
+            self.tiles[key] = tile
+            self.owned.add(key)
+        self.last_used[key] = self.clock
+        self.versions[key] = next(_versions)
+        self.dirty.add(key)
+        return tile
+
+    # Draws a stroke log command (see stroke_log.render_command), the coordinates are canvas pixels
+    # The command is drawn once in a mask of its whole rectangle, so it has the same pixels as drawn in one image
+    # (drawing it in every tile moves the pixels at the tile borders), and only the tiles it changes are touched
+    def render_command(self, command, base):
+        if command['op'] == CLEAR:
+            self.dirty.update(self.tiles, base.tiles)
+            self.tiles = dict(base.tiles)
+            self.last_used = dict(base.last_used)
+            self.versions = dict(base.versions)
+            self.owned.clear()
+            base.owned.clear()
+            return
+        rect = command_rect(command)
+        if rect is None:
+            return
+        x0, y0, x1, y1 = max(0, rect[0]), max(0, rect[1]), min(self.width, rect[2]), min(self.height, rect[3])
+        if x0 >= x1 or y0 >= y1:
+            return
+        mask = np.zeros((y1 - y0, x1 - x0), np.uint8) #The pages of a long thin shape that are never drawn on cost nothing
+        shape = command.copy()
+        shape['b'] = 255
+        render_command(mask, shape, None, 1.0, (x0, y0))
+        color = np.array((command['b'], command['g'], command['r']), np.uint8)
+
+        t = self.tile_size
+        for key in self.tile_range(x0, y0, x1, y1):
+            ox, oy = key[0] * t, key[1] * t
+            ix0, iy0, ix1, iy1 = max(x0, ox), max(y0, oy), min(x1, ox + t), min(y1, oy + t)
+            covered = mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+            if cv2.countNonZero(covered) == 0:
+                continue #The rectangle of the shape crosses the tile but the shape doesn't
+            covered = covered != 0
+            if key not in self.owned and (self.read_tile(key)[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox][covered] == color).all():
+                continue #Already that color, the tile isn't copied or created
+            self._writable_tile(key)[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox][covered] = color
+
+    # Compresses a few of the tiles that haven't been drawn on for max_age calls, meant to be called every frame
+    def compress_cold(self, max_age=150, limit=4):
+        self.clock += 1
+        cold = [key for key, used in self.last_used.items() if self.clock - used > max_age][:limit]
+        for key in cold:
+            self.tiles[key] = zlib.compress(self.tiles[key].tobytes(), 1)
+            self.owned.discard(key)
+            del self.last_used[key]
+
+    # Pixels of a rectangle of the canvas, tiles that don't exist are the background
+    def read(self, x0, y0, x1, y1):
+        img = np.empty((y1 - y0, x1 - x0, 3), np.uint8)
+        img[:] = self.background
+        t = self.tile_size
+        for tx, ty in self.tile_range(x0, y0, x1, y1):
+            if (tx, ty) not in self.tiles: continue
+            ox, oy = tx * t, ty * t
+            ix0, iy0, ix1, iy1 = max(x0, ox), max(y0, oy), min(x1, ox + t), min(y1, oy + t)
+            img[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.read_tile((tx, ty))[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+        return img
+
+    def to_image(self):
+        return self.read(0, 0, self.width, self.height)
+
+    def stats(self):
+        hot = [tile for tile in self.tiles.values() if isinstance(tile, np.ndarray)]
+        cold = [tile for tile in self.tiles.values() if isinstance(tile, bytes)]
+        return {'tiles': len(self.tiles), 'hot': len(hot), 'cold': len(cold),
+                'bytes': sum(tile.nbytes for tile in hot) + sum(len(tile) for tile in cold),
+                'full_bytes': self.width * self.height * 3}
+
+# Parses 'WIDTHxHEIGHT' or one of CANVAS_SIZES
+def parse_canvas_size(text):
+    if text.lower() in CANVAS_SIZES:
+        return CANVAS_SIZES[text.lower()]
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+# -----------------------------------------------
+# Viewport: the part of the canvas shown in the window (and drawn on with the camera)
+# -----------------------------------------------
+# canvas x = view x + window x * scale, the scale is a power of two so every tile is a whole number of window pixels
+
+def create_viewport(canvas, width, height):
+    view = {'x': 0, 'y': 0, 'scale': 1.0, 'width': width, 'height': height, 'full': True}
+    #The whole canvas is shown at the start
+    while view['scale'] < canvas.tile_size and (width * view['scale'] < canvas.width or height * view['scale'] < canvas.height):
+        view['scale'] *= 2
+    _clamp_viewport(view, canvas)
+    return view
+
+def to_canvas(view, point):
+    return (int(view['x'] + point[0] * view['scale']), int(view['y'] + point[1] * view['scale']))
+
+def _clamp_viewport(view, canvas):
+    step = max(1, int(view['scale']))
+    for axis, size, canvas_size in (('x', view['width'], canvas.width), ('y', view['height'], canvas.height)):
+        limit = max(0, canvas_size - int(size * view['scale']))
+        view[axis] = int(min(max(0, view[axis]), limit)) // step * step
+    view['full'] = True
+
+# Moves the view a fraction of its size (dx, dy in -1..1)
+def pan_viewport(view, canvas, dx, dy):
+    view['x'] += int(dx * view['width'] * view['scale'])
+    view['y'] += int(dy * view['height'] * view['scale'])
+    _clamp_viewport(view, canvas)
+
+# Zooms in (factor 2) or out (factor 0.5) keeping the center of the window in place
+def zoom_viewport(view, canvas, factor, min_scale=0.125):
+    scale = view['scale'] / factor
+    if scale < min_scale or scale > canvas.tile_size:
+        return
+    cx, cy = to_canvas(view, (view['width'] / 2, view['height'] / 2))
+    view['scale'] = scale
+    view['x'], view['y'] = int(cx - view['width'] / 2 * scale), int(cy - view['height'] / 2 * scale)
+    _clamp_viewport(view, canvas)
+
+# Renders the visible tiles that changed (all of them after a pan or zoom) in the window image
+# Returns the rectangles of the window that were rendered
+def render_viewport(canvas, view, out):
+    x, y, s = view['x'], view['y'], view['scale']
+    w, h = view['width'], view['height']
+    visible = canvas.tile_range(x, y, int(np.ceil(x + w * s)), int(np.ceil(y + h * s)))
+    if view['full']:
+        out[:] = OUTSIDE_COLOR
+        keys = visible
+    else:
+        keys = [key for key in visible if key in canvas.dirty]
+    canvas.dirty.clear()
+    view['full'] = False
+
+    rects = []
+    for key in keys:
+        rect = _render_tile(canvas, view, key, out)
+        if rect is not None:
+            rects.append(rect)
+    return rects
+
+def _render_tile(canvas, view, key, out):
+    x, y, s, t = view['x'], view['y'], view['scale'], canvas.tile_size
+    cx0, cy0 = key[0] * t, key[1] * t
+    cx1, cy1 = min(cx0 + t, canvas.width), min(cy0 + t, canvas.height)
+    #Window pixels of the tile
+    vx0, vy0 = max(0, int(np.ceil((cx0 - x) / s))), max(0, int(np.ceil((cy0 - y) / s)))
+    vx1, vy1 = min(view['width'], int(np.ceil((cx1 - x) / s))), min(view['height'], int(np.ceil((cy1 - y) / s)))
+    if vx0 >= vx1 or vy0 >= vy1:
+        return None
+    target = out[vy0:vy1, vx0:vx1]
+    if key not in canvas.tiles:
+        target[:] = canvas.background
+        return (vx0, vy0, vx1, vy1)
+
+    tile = canvas.read_tile(key)
+    if s >= 1:
+        #Every window pixel is the average of s x s canvas pixels
+        s = int(s)
+        px0, py0, px1, py1 = x + vx0 * s - cx0, y + vy0 * s - cy0, x + vx1 * s - cx0, y + vy1 * s - cy0
+        region = tile[py0:py1, px0:px1]
+        if px1 > cx1 - cx0 or py1 > cy1 - cy0:
+            #The last window pixels of the canvas also cover the part of the tile that is outside the canvas
+            region = region.copy()
+            region[cy1 - cy0 - py0:] = canvas.background
+            region[:, cx1 - cx0 - px0:] = canvas.background
+        cv2.resize(region, (vx1 - vx0, vy1 - vy0), dst=target, interpolation=cv2.INTER_AREA)
+    else:
+        #Every canvas pixel is k x k window pixels
+        k = int(round(1 / s))
+        px0, py0 = x + vx0 // k - cx0, y + vy0 // k - cy0
+        px1, py1 = x + -(-vx1 // k) - cx0, y + -(-vy1 // k) - cy0
+        big = cv2.resize(tile[py0:py1, px0:px1], None, fx=k, fy=k, interpolation=cv2.INTER_NEAREST)
+        target[:] = big[vy0 % k:vy0 % k + vy1 - vy0, vx0 % k:vx0 % k + vx1 - vx0]
+    return (vx0, vy0, vx1, vy1)
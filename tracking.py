@@ -0,0 +1,224 @@
+import cv2
+import numpy as np
+
+from buffer_pool import frame_buffers
+
+# Creates the state used to follow the pen between frames
+# recheck_interval: every N frames the downscaled frame is checked for a bigger blob outside the window
+# With 1 (default) the result is the same as a full frame search, except for blobs that vanish when downscaled
+def create_tracker(min_window=60, speed_gain=3, search_width=320, recheck_interval=1):
+    return {'center': None,             #Last centroid found (float, full frame coordinates)
+            'velocity': (0.0, 0.0),     #Pixels per frame
+            'size': (0, 0),             #Width and height of the last blob
+            'min_window': min_window,   #Minimum half size of the search window
+            'speed_gain': speed_gain,   #How much the window grows with the pen speed
+            'search_width': search_width, #Width of the downscaled image used when the pen is lost
+            'recheck_interval': recheck_interval, #Every N frames look for a bigger blob outside the window
+            'frames_tracked': 0,
+            'mode': 'search'}
+
+# Finds the biggest group of pixels of a mask, the results are in full frame coordinates
+# labels can be a buffer where the component of every pixel is written
+def find_largest_blob(mask, offset=(0, 0), connectivity=4, labels=None):
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, labels=labels, connectivity=connectivity, ltype=cv2.CV_32S)
+    if num_labels <= 1:
+        return None
+
+    idx = 1 + stats[1:, cv2.CC_STAT_AREA].argmax() #Index of the biggest area
+    x, y, w, h, area = stats[idx]
+    #The pixel coordinate sums are integers, rebuilding them keeps the centroid identical to a full frame search
+    sum_x = round(centroids[idx][0] * area) + offset[0] * int(area)
+    sum_y = round(centroids[idx][1] * area) + offset[1] * int(area)
+    return {'center': (sum_x / area, sum_y / area),
+            'bbox': (int(x) + offset[0], int(y) + offset[1], int(w), int(h)),
+            'area': int(area),
+            'labels': labels,
+            'idx': idx,
+            'offset': offset}
+
+# Checks if the blob touches a side of the window that isn't also a side of the frame (it may be cut)
+def _blob_is_clipped(blob, window, frame_shape):
+    x0, y0, x1, y1 = window
+    bx, by, bw, bh = blob['bbox']
+    fh, fw = frame_shape[:2]
+    return ((bx <= x0 and x0 > 0) or (by <= y0 and y0 > 0) or
+            (bx + bw >= x1 and x1 < fw) or (by + bh >= y1 and y1 < fh))
+
+# Every kind of search has its own buffers (name), so a blob found before isn't overwritten
+def _search_window(frame, segment, window, name):
+    x0, y0, x1, y1 = window
+    shape = (y1 - y0, x1 - x0)
+    mask = segment(frame[y0:y1, x0:x1], dst=frame_buffers.get(name + '_mask', shape))
+    return find_largest_blob(mask, (x0, y0), labels=frame_buffers.get(name + '_labels', shape, np.int32))
+
+# Mask of the pen in a downscaled copy of the frame, every pixel is one of scale x scale
+def _coarse_mask(frame, segment, tracker):
+    scale = max(1, frame.shape[1] // tracker['search_width'])
+    #Nearest neighbour downscale without any interpolation cost
+    small = frame_buffers.get('coarse_frame', frame[::scale, ::scale].shape)
+    np.copyto(small, frame[::scale, ::scale])
+    return segment(small, dst=frame_buffers.get('coarse_mask', small.shape[:2])), scale
+
+# Looks for the pen in a downscaled copy of the frame and then refines the result at full resolution
+def _coarse_search(frame, segment, tracker):
+    fh, fw = frame.shape[:2]
+    mask, scale = _coarse_mask(frame, segment, tracker)
+    coarse = find_largest_blob(mask, labels=frame_buffers.get('coarse_labels', mask.shape, np.int32))
+    if coarse is None:
+        if scale == 1:
+            return None
+        #A small pen can vanish after downscaling, the full frame is the last option
+        return _search_window(frame, segment, (0, 0, fw, fh), 'full')
+
+    bx, by, bw, bh = coarse['bbox']
+    margin = 2 * scale
+    window = (max(0, bx * scale - margin), max(0, by * scale - margin),
+              min(fw, (bx + bw) * scale + margin), min(fh, (by + bh) * scale + margin))
+    blob = _search_window(frame, segment, window, 'refine')
+    if blob is not None and _blob_is_clipped(blob, window, frame.shape):
+        blob = _search_window(frame, segment, (0, 0, fw, fh), 'full')
+    return blob
+
+# Checks the downscaled frame for a blob that could be bigger than the tracked one
+# A blob of the downscaled mask with a bw x bh box is at most (bw + 1) x (bh + 1) x scale^2 pixels at full resolution
+def _bigger_blob_possible(frame, segment, tracker, blob):
+    mask, scale = _coarse_mask(frame, segment, tracker)
+    num_labels, _, stats, _ = cv2.connectedComponentsWithStats(
+        mask, labels=frame_buffers.get('coarse_labels', mask.shape, np.int32), connectivity=4, ltype=cv2.CV_32S)
+    x, y, w, h = blob['bbox']
+    for cx, cy, cw, ch, _ in stats[1:num_labels]:
+        x0, y0, x1, y1 = cx * scale, cy * scale, (cx + cw) * scale, (cy + ch) * scale
+        if x0 < x + w and x < x1 and y0 < y + h and y < y1:
+            #The tracked blob itself, unless something joined to it reaches outside its box
+            if x0 < x - 2 * scale or y0 < y - 2 * scale or x1 > x + w + 2 * scale or y1 > y + h + 2 * scale:
+                return True
+        elif (cw + 1) * (ch + 1) * scale * scale > blob['area']:
+            return True
+    return False
+
+# Finds the pen, only around its last position when it is being tracked
+# segment(image) returns the mask (255) of the pen pixels of an image, e.g. color_classifier.pen_mask
+def track_marker(frame, segment, tracker):
+    fh, fw = frame.shape[:2]
+    blob = None
+
+    if tracker['center'] is not None:
+        #....Window around the predicted position, bigger when the pen moves fast....
+        vx, vy = tracker['velocity']
+        cx, cy = tracker['center'][0] + vx, tracker['center'][1] + vy
+        speed = max(abs(vx), abs(vy))
+        half_w = int(max(tracker['min_window'], tracker['size'][0]) + tracker['speed_gain'] * speed)
+        half_h = int(max(tracker['min_window'], tracker['size'][1]) + tracker['speed_gain'] * speed)
+        window = (max(0, int(cx) - half_w), max(0, int(cy) - half_h),
+                  min(fw, int(cx) + half_w + 1), min(fh, int(cy) + half_h + 1))
+
+        if window[0] < window[2] and window[1] < window[3]:
+            blob = _search_window(frame, segment, window, 'track')
+            if blob is not None and _blob_is_clipped(blob, window, frame.shape):
+                blob = None #The pen may continue outside the window, do a full search
+
+        #Make sure there isn't a bigger blob somewhere else, the full frame is only searched when there may be one
+        tracker['frames_tracked'] += 1
+        if blob is not None and tracker['frames_tracked'] % tracker['recheck_interval'] == 0:
+            if _bigger_blob_possible(frame, segment, tracker, blob):
+                blob = _search_window(frame, segment, (0, 0, fw, fh), 'full')
+
+    if blob is None:
+        tracker['mode'] = 'search'
+        blob = _coarse_search(frame, segment, tracker)
+    else:
+        tracker['mode'] = 'track'
+
+    #....Tracker update....
+    if blob is None:
+        tracker['center'] = None
+        tracker['velocity'] = (0.0, 0.0)
+        tracker['frames_tracked'] = 0
+        return None
+
+    if tracker['center'] is not None:
+        tracker['velocity'] = (blob['center'][0] - tracker['center'][0], blob['center'][1] - tracker['center'][1])
+    tracker['center'] = blob['center']
+    tracker['size'] = blob['bbox'][2:]
+    return blob
+
+# Zeroes the pixels of mask whose right or lower neighbour is another pen, so pens that touch are separate components
+# (with 4-connectivity), the pass over the label image is still a single one
+def _split_touching_pens(labels, mask):
+    h, w = labels.shape
+    right = frame_buffers.get('pens_right', (h, w - 1))
+    down = frame_buffers.get('pens_down', (h - 1, w))
+    #Both neighbours have a pen and it isn't the same one
+    cv2.compare(labels[:, :-1], labels[:, 1:], cv2.CMP_NE, dst=right)
+    cv2.bitwise_and(right, mask[:, 1:], dst=right)
+    cv2.compare(labels[:-1], labels[1:], cv2.CMP_NE, dst=down)
+    cv2.bitwise_and(down, mask[1:], dst=down)
+    #Only after both are computed, the neighbours must still be the original mask
+    cv2.subtract(mask[:, :-1], right, dst=mask[:, :-1])
+    cv2.subtract(mask[:-1], down, dst=mask[:-1])
+
+# Finds the biggest blob of every pen with a single connected components pass over the label image
+# labels comes from color_classifier.classify (0 = no pen, i + 1 = pen i)
+def find_pen_blobs(labels, num_pens, connectivity=4):
+    mask = cv2.compare(labels, 0, cv2.CMP_GT, dst=frame_buffers.get('pens_mask', labels.shape))
+    if num_pens > 1:
+        _split_touching_pens(labels, mask)
+    num_components, components, stats, centroids = cv2.connectedComponentsWithStats(
+        mask, labels=frame_buffers.get('pens_labels', labels.shape, np.int32), connectivity=connectivity, ltype=cv2.CV_32S)
+    blobs = [None] * num_pens
+    if num_components <= 1:
+        return blobs
+
+    #....Pen of every component, the most common label among its pixels....
+    pixels = np.flatnonzero(mask)
+    votes = np.bincount(components.ravel()[pixels] * (num_pens + 1) + labels.ravel()[pixels],
+                        minlength=num_components * (num_pens + 1)).reshape(num_components, num_pens + 1)
+    component_pen = votes[:, 1:].argmax(axis=1)
+
+    #....Biggest component of every pen....
+    areas = stats[:, cv2.CC_STAT_AREA]
+    for idx in np.argsort(-areas[1:]) + 1:
+        pen = component_pen[idx]
+        if blobs[pen] is None:
+            x, y, w, h, area = stats[idx]
+            blobs[pen] = {'center': (centroids[idx][0], centroids[idx][1]),
+                          'bbox': (int(x), int(y), int(w), int(h)),
+                          'area': int(area),
+                          'labels': components,
+                          'idx': idx,
+                          'offset': (0, 0)}
+    return blobs
+
+# Merges the blob mask with the camera image, only the pixels inside the blob bounding box are touched
+def highlight_blob(frame, blob):
+    return highlight_blobs(frame, [blob])
+
+# Highlight of the pens with a cross in their centers, in the color of every pen
+def highlight_pens(frame, blobs, colors):
+    frame_with_highlight = highlight_blobs(frame, blobs)
+    for blob, color in zip(blobs, colors):
+        if blob is None: continue
+        center_x, center_y = int(blob['center'][0]), int(blob['center'][1]) #this is needed because centroids came in float type
+        cv2.line(frame_with_highlight, (center_x-5,center_y-5), (center_x+5,center_y+5), color, 2)
+        cv2.line(frame_with_highlight, (center_x+5,center_y-5), (center_x-5,center_y+5), color, 2)
+    return frame_with_highlight
+
+# The returned image is a reused buffer, it is only valid until the next frame
+def highlight_blobs(frame, blobs):
+    frame_with_highlight = frame_buffers.get('highlight', frame.shape)
+    np.copyto(frame_with_highlight, frame)
+    for blob in blobs:
+        if blob is None: continue
+        x, y, w, h = blob['bbox']
+        if blob['labels'] is None:
+            #Blobs found in another process have no label image, only their box is shown
+            cv2.rectangle(frame_with_highlight, (x, y), (x + w - 1, y + h - 1), (255, 255, 255), 2)
+            continue
+        ox, oy = blob['offset']
+        local_labels = blob['labels'][y - oy:y - oy + h, x - ox:x - ox + w]
+
+        blob_mask = cv2.compare(local_labels, int(blob['idx']), cv2.CMP_EQ, dst=frame_buffers.get('blob_mask', (h, w))) #Creates a mask
+        blob_mask = cv2.cvtColor(blob_mask, cv2.COLOR_GRAY2BGR, dst=frame_buffers.get('blob_mask_bgr', (h, w, 3))) #Convert to color to merge
+        roi = frame_with_highlight[y:y + h, x:x + w]
+        cv2.addWeighted(roi, 1, blob_mask, 0.5, 0, dst=roi)
+    return frame_with_highlight